@@ -9,14 +9,48 @@ try:
 except ModuleNotFoundError:
     pass
 
-from .basic_dso import DSO
+from .basic_dso import DSO, codes_to_volts
 
 
 class AgilentDSO(DSO):
 
+    # Settings which depend on the timebase and acquisition setup
+    TIMING_SETTINGS = ("time_scale", "sampling_rate", "buffer_size", "points_num", "time_resolution")
+    # Per-channel settings
+    CHANNEL_SETTINGS = ("v_scale", "y_increment", "y_origin")
+    # Settings which differ between the running and the stopped DSO, e.g. the memory size
+    ACQUISITION_STATE_SETTINGS = ("buffer_size", "points_num", "time_resolution")
+
     def __init__(self, scope):
         super().__init__()
         self.scope = scope
+        # Cached results of SCPI queries keyed by (channel, setting), channel is None for global settings
+        self.settings_cache = dict()
+
+    def query_cached(self, setting, command, convert=str, ch=None):
+        """
+        Returns the cached setting value, queries the DSO only if the value is not cached yet.
+        """
+        key = (ch, setting)
+        try:
+            return self.settings_cache[key]
+        except KeyError:
+            value = convert(self.scope.command(command))
+            self.settings_cache[key] = value
+            return value
+
+    def invalidate(self, settings, ch=None):
+        """
+        Drops the given settings from the cache so they are queried again on next access.
+        """
+        for setting in settings:
+            self.settings_cache.pop((ch, setting), None)
+
+    def refresh(self):
+        """
+        Drops all cached settings, e.g. after the DSO was adjusted from the front panel.
+        """
+        self.settings_cache.clear()
 
     @property
     def instrument_data(self):
@@ -30,33 +64,33 @@ class AgilentDSO(DSO):
 
     @property
     def time_scale(self):
-        self.__time_scale = float(self.scope.command(":TIMebase:SCALe?"))
-        return self.__time_scale
+        return self.query_cached("time_scale", ":TIMebase:SCALe?", float)
 
     @time_scale.setter
     def time_scale(self, new_time_scale):
         self.scope.command(f":TIMebase:SCALe {new_time_scale:0.1E}", no_response=True)
-        self.__time_scale = float(self.scope.command(":TIMebase:SCALe?"))
+        self.invalidate(self.TIMING_SETTINGS)
 
     @property
     def sampling_rate(self):
-        self.__sampling_rate = float(self.scope.command(":ACQuire:SRATe?"))
-        return self.__sampling_rate
+        return self.query_cached("sampling_rate", ":ACQuire:SRATe?", float)
 
     @sampling_rate.setter
     def sampling_rate(self, new_sampling_rate):
         self.scope.command(f":ACQuire:SRATe {new_sampling_rate:0.1E}", no_response=True)
-        self.__sampling_rate = float(self.scope.command(":ACQuire:SRATe?"))
+        self.invalidate(self.TIMING_SETTINGS)
 
     def get_v_scale(self, ch=1):
-        return float(self.scope.command(f":CHAN{ch:d}:SCALe?"))
+        return self.query_cached("v_scale", f":CHAN{ch:d}:SCALe?", float, ch=ch)
 
     def set_v_scale(self, ch=1, v_scale=1.0):
         self.scope.command(f":CHAN{ch:d}:SCALe {v_scale:0.1E}", no_response=True)
+        self.invalidate(self.CHANNEL_SETTINGS, ch=ch)
 
     def set_ch_coupling(self, ch=1, coupling="DC"):
         # DC | AC | GND
         self.scope.command(f":CHAN{ch:d}:COUPling {coupling}", no_response=True)
+        self.invalidate(self.CHANNEL_SETTINGS, ch=ch)
 
     def set_ch_bwlimit(self, ch=1, bwlimit=0):
         # 1 for BW limit ~ 25MHz
@@ -65,14 +99,17 @@ class AgilentDSO(DSO):
     def set_ch_probe(self, ch=1, attn=1):
         # 1 | 10 | 100 | 1000
         self.scope.command(f":CHAN{ch:d}:PROBe {attn:d}", no_response=True)
+        self.invalidate(self.CHANNEL_SETTINGS, ch=ch)
 
     def set_ch_invert(self, ch=1, invert=0):
         # 1 = Invert ON, 0 = Invert OFF
         self.scope.command(f":CHAN{ch:d}:INVert {invert:d}", no_response=True)
+        self.invalidate(self.CHANNEL_SETTINGS, ch=ch)
 
     def set_ch_display(self, ch=1, display=1):
         # 1 = ON, 0 = OFF
         self.scope.command(f":CHAN{ch:d}:DISPlay {display:d}", no_response=True)
+        self.invalidate(self.CHANNEL_SETTINGS, ch=ch)
 
     def set_trigger_mode(self, mode="EDGE"):
         # EDGE | PULSE | TV
@@ -108,42 +145,77 @@ class AgilentDSO(DSO):
 
     def set_run(self):
         self.scope.command(":RUN", no_response=True)
+        self.invalidate(self.ACQUISITION_STATE_SETTINGS)
 
     def set_stop(self):
         self.scope.command(":STOP", no_response=True)
+        self.invalidate(self.ACQUISITION_STATE_SETTINGS)
 
     def set_single(self):
         self.scope.command(":SINGLE", no_response=True)
+        self.invalidate(self.ACQUISITION_STATE_SETTINGS)
 
     @property
     def buffer_size(self):
         # return int(self.scope.command(":WAVeform:WINMemsize?"))
-        return int(self.scope.command(":WAVeform:SYSMemsize?"))
+        return self.query_cached("buffer_size", ":WAVeform:SYSMemsize?", int)
 
     def set_points_mode(self, points_mode="MAX"):
         # NORM | MAX | RAW
         self.scope.command(f":WAVeform:POINts:MODE {points_mode.upper()}", no_response=True)
+        self.invalidate(("points_mode", "buffer_size", "points_num", "time_resolution"))
 
     def get_points_mode(self):
         # NORM | MAX | RAW
-        return self.scope.command(":WAVeform:POINts:MODE?")
+        return self.query_cached("points_mode", ":WAVeform:POINts:MODE?")
 
     def set_points_num(self, points_num=600):
-        if points_num > self.buffer_size:
-            points_num = self.buffer_size
+        buffer_size = self.buffer_size
+        if points_num > buffer_size:
+            points_num = buffer_size
         print(f"SETTING POINT NUM {points_num:d}")
         self.scope.command(f":WAVeform:POINts {points_num:d}", no_response=True)
+        # the DSO may limit the number of points depending on its state, so query it again on next access
+        self.invalidate(("points_num", "time_resolution"))
 
     def get_points_num(self):
-        return int(self.scope.command(":WAVeform:POINts?"))
+        return self.query_cached("points_num", ":WAVeform:POINts?", int)
 
     @property
     def time_resolution(self):
-        return float(self.scope.command(":WAVeform:XINCrement?"))
+        return self.query_cached("time_resolution", ":WAVeform:XINCrement?", float)
 
-    def _read_data(self, ch=1, num=-1, raw=False):
-        return self.scope.read_screen(channel=ch, num=num, raw=raw)
-        # return self.scope.read_memory(channel=ch)
+    def set_waveform_source(self, ch=1):
+        """
+        Selects the channel for waveform queries, the command is sent only if the source changes.
+        """
+        if self.settings_cache.get((None, "waveform_source")) != ch:
+            self.scope.command(f":WAV:SOUR CHANNEL{ch:d}", no_response=True)
+            self.settings_cache[(None, "waveform_source")] = ch
+
+    def get_y_scale(self, ch=1):
+        """
+        Returns y_increment and y_origin of the channel needed to convert ADC codes to volts.
+        """
+        if (ch, "y_increment") not in self.settings_cache or (ch, "y_origin") not in self.settings_cache:
+            self.set_waveform_source(ch)
+        y_increment = self.query_cached("y_increment", ":WAV:YINC?", float, ch=ch)
+        y_origin = self.query_cached("y_origin", ":WAV:YOR?", float, ch=ch)
+        return y_increment, y_origin
+
+    def _read_codes(self, ch=1, num=-1, raw=False):
+        self.set_waveform_source(ch)
+        data = self.scope.read_waveform(":WAV:DATA?", num=num, raw=raw)
+        # data = self.scope.read_waveform(":WAV:MEM?", num=num, raw=raw)
+        y_increment, y_origin = self.get_y_scale(ch)
+        return data, y_increment, y_origin
+
+    def _read_channels_codes(self, channels, num=-1, raw=False):
+        # scale is taken from the cache, so only waveform transfers are left per trigger
+        scales = [self.get_y_scale(ch) for ch in channels]
+        waveforms = self.scope.read_waveforms(channels, ":WAV:DATA?", num=num, raw=raw)
+        self.settings_cache[(None, "waveform_source")] = channels[-1]
+        return [(data, y_increment, y_origin) for data, (y_increment, y_origin) in zip(waveforms, scales)]
 
     def close(self):
         self.scope.close()
@@ -151,10 +223,18 @@ class AgilentDSO(DSO):
 
 class DSO3000(AgilentDSO):
 
-    def __init__(self):
-        scope = DSO3000com()
+    def __init__(self, char_delay="auto", serial=None):
+        if char_delay == "auto":
+            scope = DSO3000com(calibrate=True, serial=serial)
+        else:
+            scope = DSO3000com(calibrate=False, serial=serial)
+            scope.char_delay = float(char_delay)
         super().__init__(scope=scope)
 
+    @property
+    def transport_stats(self):
+        return self.scope.transport_stats
+
     def set_points_mode(self, points_mode="MAX"):
         # NORM | MAX | RAW
         pass
@@ -162,9 +242,9 @@ class DSO3000(AgilentDSO):
 
 class DSO1000(AgilentDSO):
 
-    def __init__(self, device=0x0588):
+    def __init__(self, device=0x0588, serial=None):
         vendor = 0x0957
-        scope = DSO1000com(vendor=vendor, device=device)
+        scope = DSO1000com(vendor=vendor, device=device, serial=serial)
         super().__init__(scope=scope)
 
 
@@ -193,41 +273,69 @@ class AgilentDSOcom:
         if not no_response:
             return s
 
-    def read_data(self, command, num=-1, raw=False):
+    def parse_data(self, response, raw=False):
         """
-        Reads waveform data with the given command and returns the waveform in volts.
+        Parses the waveform data response into the array of uint8 ADC readings.
         """
-        # Send the command
-        response = self.command(command, num=-1, raw=raw)
         if raw:
             data_bytes = response
         else:
-            # Parse the result into ADC readings
             data_bytes = bytearray.fromhex(response.replace("0x", "").replace(" ", ""))
-        data = np.frombuffer(data_bytes, np.uint8).astype(int)
+        return np.frombuffer(data_bytes, np.uint8)
+
+    def read_waveform(self, command, num=-1, raw=False):
+        """
+        Reads waveform data with the given command and returns the raw ADC codes.
+        """
+        # Send the command
+        response = self.command(command, num=num, raw=raw)
+        # Parse the result into ADC readings
+        return self.parse_data(response, raw=raw)
+
+    def read_waveforms(self, channels, command, num=-1, raw=False):
+        """
+        Reads waveform data of several channels with the given command and returns the list of raw ADC codes.
+        Source selection and the data query are sent as one compound command,
+        so each channel costs a single request/response turnaround.
+        """
+        return [self.read_waveform(f":WAV:SOUR CHANNEL{channel:d};{command}", num=num, raw=raw)
+                for channel in channels]
+
+    def read_codes(self, command, num=-1, raw=False):
+        """
+        Reads waveform data with the given command and returns the raw ADC codes
+        together with y_increment and y_origin needed to convert them to volts.
+        """
+        data = self.read_waveform(command, num=num, raw=raw)
 
         # Get channel configuration needed to convert to volts
         y_increment = float(self.command(":WAV:YINC?"))
         y_origin = float(self.command(":WAV:YOR?"))
+        return data, y_increment, y_origin
 
-        # Convert ADC readings to volts.
-        # Agilent's Programmer's Reference appears to have this formula right,
-        # but setting a channel to GND produces all 126's (one count below zero volts).
-        return (125.0 - data) * y_increment - y_origin
+    def read_data(self, command, num=-1, raw=False):
+        """
+        Reads waveform data with the given command and returns the waveform in volts.
+        """
+        return codes_to_volts(*self.read_codes(command, num=num, raw=raw))
 
-    def read_memory(self, channel, num=-1, raw=False):
+    def read_memory(self, channel, num=-1, raw=False, volts=True):
         """
         Reads waveform memory for the given channel (1 or 2)
         """
         self.command(f":WAV:SOUR CHANNEL{channel:d}", no_response=True)
-        return self.read_data(':WAV:MEM?', num=num, raw=raw)
+        if volts:
+            return self.read_data(':WAV:MEM?', num=num, raw=raw)
+        return self.read_codes(':WAV:MEM?', num=num, raw=raw)
 
-    def read_screen(self, channel, num=-1, raw=False):
+    def read_screen(self, channel, num=-1, raw=False, volts=True):
         """
         Reads the waveform on the screen for the given channel (1 or 2)
         """
         self.command(f":WAV:SOUR CHANNEL{channel:d}", no_response=True)
-        return self.read_data(":WAV:DATA?", num=num, raw=raw)
+        if volts:
+            return self.read_data(":WAV:DATA?", num=num, raw=raw)
+        return self.read_codes(":WAV:DATA?", num=num, raw=raw)
 
     def close(self):
         pass
@@ -243,24 +351,86 @@ class DSO3000com(AgilentDSOcom):
       print scope.readScreen(1)              # Read waveform in volts
     """
 
-    def __init__(self, flush=True):
+    # Delay after each written character the DSO is known to handle
+    SAFE_CHAR_DELAY = 0.003
+    # Delays tried by calibrate() in descending order
+    CALIBRATION_DELAYS = (0.002, 0.0015, 0.001, 0.0007, 0.0005, 0.0003, 0.0002, 0.0001, 0.0)
+
+    def __init__(self, flush=True, calibrate=False, serial=None):
         """
-        Finds and opens the scope's USB device.
+        Finds and opens the scope's USB device, the one with given USB serial number if several are connected.
         If flush==True, any pending data is discarded.
+        If calibrate==True, the shortest safe delay between written characters is measured.
         """
         super().__init__()
+        self.char_delay = self.SAFE_CHAR_DELAY
+        # Time in seconds to wait for the response to a query
+        self.response_timeout = 1.0
+        self.commands_num = 0
+        self.chars_written = 0
+        self.bytes_read = 0
+        self.write_time = 0.0
+        self.read_time = 0.0
 
         for bus in usb.busses():
             for dev in bus.devices:
                 if dev.idVendor == 0x0400 and dev.idProduct == 0xc55d:
-                    self.device = dev.open()
+                    # the handle opened to read the serial number is used for the selected device
+                    handle = dev.open()
+                    if serial is not None and handle.getString(dev.iSerialNumber, 64) != serial:
+                        # releases the handle of the probed device
+                        del handle
+                        continue
+                    self.device = handle
                     self.device.setConfiguration(1)
                     self.device.claimInterface(0)
                     break
+            if self.device:
+                break
         if not self.device:
+            if serial is not None:
+                raise IOError(f"No USB oscilloscope with serial number {serial} found")
             raise IOError("No USB oscilloscope found")
         if flush:
             self.read()
+        if calibrate:
+            self.calibrate()
+
+    def calibrate(self, tries=3, margin=1.5):
+        """
+        Finds the shortest delay between written characters which gives correct responses.
+        The delay is decreased while `tries` *IDN? queries in a row return the reference response
+        obtained with the safe delay, the last good delay multiplied by margin is used.
+        """
+        self.char_delay = self.SAFE_CHAR_DELAY
+        reference = self.command("*IDN?")
+        if not reference:
+            return self.char_delay
+        good_delay = self.SAFE_CHAR_DELAY
+        for delay in self.CALIBRATION_DELAYS:
+            self.char_delay = delay
+            if not all(self.command("*IDN?") == reference for _ in range(tries)):
+                # terminate a garbled command and discard its response
+                self.write_char("\r")
+                time.sleep(self.SAFE_CHAR_DELAY)
+                self.read()
+                break
+            good_delay = delay
+        self.char_delay = min(good_delay * margin, self.SAFE_CHAR_DELAY)
+        return self.char_delay
+
+    @property
+    def transport_stats(self):
+        busy_time = self.write_time + self.read_time
+        return {
+            "char_delay": self.char_delay,
+            "commands": self.commands_num,
+            "chars_written": self.chars_written,
+            "bytes_read": self.bytes_read,
+            "commands_per_s": self.commands_num / busy_time if busy_time > 0 else None,
+            "write_chars_per_s": self.chars_written / self.write_time if self.write_time > 0 else None,
+            "read_bytes_per_s": self.bytes_read / self.read_time if self.read_time > 0 else None
+        }
 
     def write_char(self, ch):
         """
@@ -272,10 +442,14 @@ class DSO3000com(AgilentDSOcom):
         """
         Writes a string and an end-of-line to the scope
         """
+        write_start = time.perf_counter()
         for ch in s:
-            self.write_char(ch)
-            time.sleep(0.003)
-        self.write_char("\r")
+            self.device.controlMsg(0xc0, 1, 0, ord(ch), 0, self.timeout)
+            if self.char_delay > 0:
+                time.sleep(self.char_delay)
+        self.device.controlMsg(0xc0, 1, 0, 13, 0, self.timeout)
+        self.chars_written += len(s) + 1
+        self.write_time += time.perf_counter() - write_start
 
     def get_response_length(self):
         """
@@ -284,19 +458,38 @@ class DSO3000com(AgilentDSOcom):
         """
         return self.device.controlMsg(0xc0, 0, 1, 0, 0, self.timeout)[0]
 
-    def read(self):
+    def read_bytes(self):
         """
-        Reads as much data as is currently available
+        Reads as much data as is currently available as bytearray
         """
-        response = ""
+        read_start = time.perf_counter()
+        response = bytearray()
         while True:
             n = self.get_response_length()
             if n == 0:
                 break
-            data = self.device.controlMsg(0xc0, 0, n, 1, 0, self.timeout)
-            response += ''.join(chr(x) for x in data).rstrip('\r\n')
+            response += bytes(self.device.controlMsg(0xc0, 0, n, 1, 0, self.timeout))
+        self.bytes_read += len(response)
+        self.read_time += time.perf_counter() - read_start
         return response
 
+    def read(self):
+        """
+        Reads as much data as is currently available
+        """
+        return self.read_bytes().decode("latin-1").rstrip("\r\n")
+
+    def wait_response(self):
+        """
+        Waits until the response to a query is available or response_timeout expires.
+        """
+        wait_start = time.perf_counter()
+        while self.get_response_length() == 0:
+            if time.perf_counter() - wait_start > self.response_timeout:
+                break
+            time.sleep(0.0001)
+        self.read_time += time.perf_counter() - wait_start
+
     def command(self, s, no_response=False, num=-1, raw=False):
         """
         Writes a command string and returns the response (if any)
@@ -304,8 +497,11 @@ class DSO3000com(AgilentDSOcom):
 
         # Write the command
         self.write(s)
+        self.commands_num += 1
 
         # Read the response
+        if s.endswith("?") and not no_response:
+            self.wait_response()
         response = self.read()
         if not response:
             # No response text
@@ -316,6 +512,17 @@ class DSO3000com(AgilentDSOcom):
         # Keep everything up to the first newline.
         return response.splitlines()[0]
 
+    def read_waveforms(self, channels, command, num=-1, raw=False):
+        """
+        Reads waveform data of several channels with the given command and returns the list of raw ADC codes.
+        The source is selected with a separate command as the firmware may not handle compound commands.
+        """
+        waveforms = []
+        for channel in channels:
+            self.command(f":WAV:SOUR CHANNEL{channel:d}", no_response=True)
+            waveforms.append(self.read_waveform(command, num=num, raw=raw))
+        return waveforms
+
     def raw_screenshot(self):
         """
         Reads a screenshot from the scope.  Returns a 76800-element array
@@ -345,7 +552,10 @@ class DSO3000com(AgilentDSOcom):
 
 class DSO1000com(AgilentDSOcom):
 
-    def __init__(self, vendor=0x0957, device=0x0588):
+    def __init__(self, vendor=0x0957, device=0x0588, serial=None):
+        """
+        Opens the USBTMC device with given VID and PID, the one with given USB serial number if several are connected.
+        """
         super().__init__()
         if vendor is None:
             print("Provide a valid USBTMC vendor ID, e.g. 0x0957")
@@ -363,15 +573,29 @@ class DSO1000com(AgilentDSOcom):
         for dev in devs:
             # match VID and PID
             if dev.idVendor == vendor and dev.idProduct == device:
+                if serial is not None and self.serial_number(dev) != serial:
+                    continue
                 dso_device = dev
                 break
         if dso_device is None:
+            if serial is not None:
+                print(f"No USB oscilloscope with serial number {serial}, connected:",
+                      [self.serial_number(dev) for dev in devs])
+                raise IOError(f"No USB oscilloscope with serial number {serial} found")
             print("Provide a valid USBTMC device ID, e.g. 0x0588")
             print(usbtmc.list_devices())
             raise IOError("No USB oscilloscope found")
         self.device = usbtmc.Instrument(dso_device)
         self.device.open()
 
+    @staticmethod
+    def serial_number(dev):
+        try:
+            return dev.serial_number
+        except (ValueError, usb.core.USBError):
+            # no permission to read the string descriptors
+            return None
+
     def command(self, s, no_response=False, num=-1, raw=False):
         if no_response:
             self.device.write(s)
@@ -380,27 +604,15 @@ class DSO1000com(AgilentDSOcom):
                 return self.device.ask_raw(s.encode("utf-8"), num=num)
             return self.device.ask(s, num=num)
 
-    def read_data(self, command, num=-1, raw=False):
+    def parse_data(self, response, raw=False):
         """
-        Reads waveform data with the given command and returns the waveform in volts.
+        Parses the waveform data response into the array of uint8 ADC readings.
         """
-        # Send the command
-        response = self.command(command, num=num, raw=raw)
         if raw:
             data_bytes = response
         else:
             data_bytes = bytearray(response.encode('utf-8'))
-        # Parse the result into ADC readings
-        data = np.frombuffer(data_bytes, np.uint8).astype(int)
-
-        # Get channel configuration needed to convert to volts
-        y_increment = float(self.command(":WAV:YINC?"))
-        y_origin = float(self.command(":WAV:YOR?"))
-
-        # Convert ADC readings to volts.
-        # Agilent's Programmer's Reference appears to have this formula right,
-        # but setting a channel to GND produces all 126's (one count below zero volts).
-        return (125.0 - data) * y_increment - y_origin
+        return np.frombuffer(data_bytes, np.uint8)
 
     def close(self):
         self.device.close()
@@ -0,0 +1,96 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .single_shot import SingleShotCycle
+from .trigger_poller import TriggerPoller
+
+
+class AsyncDSO:
+    """
+    Asyncio facade over a blocking DSO driver.
+
+    Every driver call runs on the dedicated single thread executor of the device,
+    so the USB commands of one DSO stay serialized and a slow call never blocks the event loop
+    or the other devices.
+    """
+
+    def __init__(self, scope, name="DSO"):
+        self.scope = scope
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs the blocking function on the device executor.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def call(self, method, *args, **kwargs):
+        return await self.run(getattr(self.scope, method), *args, **kwargs)
+
+    async def get_trigger_status(self):
+        return await self.call("get_trigger_status")
+
+    async def force_trig(self):
+        await self.call("force_trig")
+
+    async def set_run(self):
+        await self.call("set_run")
+
+    async def set_stop(self):
+        await self.call("set_stop")
+
+    async def set_single(self):
+        await self.call("set_single")
+
+    async def read_channels(self, channels, num=-1, raw=False, volts=True):
+        return await self.call("read_channels", channels, num=num, raw=raw, volts=volts)
+
+    async def record_time(self):
+        return await self.run(lambda: self.scope.buffer_size * self.scope.time_resolution)
+
+    async def records(self, channels, raw=True, volts=True, trigger_force=False, force_interval=0.0, poller=None,
+                      duration=None, metrics=None):
+        """
+        Asynchronous generator of multi-channel records acquired in single shot mode.
+        The DSO is re-armed with :SINGLE right after the waveforms transfer, before the record is yielded.
+        Records have the acquisition timestamps, as in the blocking acquisition loop.
+        """
+        if poller is None:
+            poller = TriggerPoller(mode="busy")
+        record_time = await self.record_time()
+        num = await self.call("get_points_num")
+        loop_stop = None if duration is None else time.monotonic() + duration
+        await self.set_stop()
+        await self.set_single()
+        cycle = SingleShotCycle(poller, record_time, trigger_force=trigger_force, force_interval=force_interval,
+                                metrics=metrics)
+        while loop_stop is None or time.monotonic() < loop_stop:
+            poll_start = time.time_ns()
+            trigger_status = await self.get_trigger_status()
+            if metrics is not None:
+                metrics.observe_ns("trigger_poll", time.time_ns() - poll_start)
+                metrics.inc("trigger_polls")
+            action = cycle.step(trigger_status)
+            if action == cycle.READ:
+                record = await self.read_channels(channels, num=num, raw=raw, volts=volts)
+                await self.set_single()
+                cycle.rearmed()
+                if metrics is not None:
+                    metrics.observe_ns("usb_read", record["timestamp_stop"] - record["timestamp_start"])
+                record["timestamp_start"] = cycle.acquisition_start
+                record["timestamp_stop"] = cycle.acquisition_stop
+                cycle.completed()
+                yield record
+                continue
+            if action == cycle.FORCE:
+                await self.force_trig()
+                cycle.forced()
+            await asyncio.sleep(poller.next_delay())
+
+    async def close(self):
+        await self.call("close")
+        self.executor.shutdown(wait=True)
@@ -2,11 +2,46 @@ import time
 import numpy as np
 
 
+# ADC code corresponding to zero volts on screen
+ADC_ZERO = 125
+
+
+def codes_to_volts(codes, y_increment, y_origin, y_zero=ADC_ZERO, out=None):
+    """
+    Converts raw 8-bit ADC codes to volts.
+    If out array is given, the result is written into it in place without temporary arrays.
+    """
+    # Agilent's Programmer's Reference appears to have this formula right,
+    # but setting a channel to GND produces all 126's (one count below zero volts).
+    if out is None:
+        return (float(y_zero) - codes) * y_increment - y_origin
+    np.subtract(float(y_zero), codes, out=out, dtype=out.dtype)
+    np.multiply(out, y_increment, out=out)
+    np.subtract(out, y_origin, out=out)
+    return out
+
+
+def split_channels(record):
+    """
+    Splits multi-channel record returned by DSO.read_channels() into single channel records.
+    """
+    shared = {key: value for key, value in record.items() if key != "channels"}
+    return [{**shared, **channel} for channel in record["channels"]]
+
+
 class DSO:
 
     def __init__(self):
         self.__time_scale = 1e-6
         self.__sampling_rate = 1e9
+        # Reusable per-channel output buffers for conversion to volts
+        self.volts_dtype = np.float64
+        self.volts_buffers_num = 0
+        self.volts_buffers = dict()
+        self.volts_buffer_index = dict()
+
+    def refresh(self):
+        pass
 
     @property
     def instrument_data(self):
@@ -111,22 +146,92 @@ class DSO:
     def time_resolution(self):
         return 1e-9
 
-    def read_data(self, ch=1, num=-1, raw=False):
+    def read_data(self, ch=1, num=-1, raw=False, volts=True):
+        """
+        Reads the waveform of the channel.
+        If volts==False, the raw uint8 ADC codes are returned together with
+        the scale needed to convert them to volts.
+        """
+        timestamp_start = time.time_ns()
+        data, y_increment, y_origin = self._read_codes(ch=ch, num=num, raw=raw)
+        timestamp_stop = time.time_ns()
+        record = {
+            "timestamp_start": timestamp_start,
+            "timestamp_stop": timestamp_stop,
+            "time_resolution": self.time_resolution,
+            "sampling_rate": self.sampling_rate,
+        }
+        record.update(self._channel_record(ch, data, y_increment, y_origin, volts=volts))
+        return record
+
+    def read_channels(self, channels, num=-1, raw=False, volts=True):
+        """
+        Reads the waveforms of several channels in one pass.
+        Returns multi-channel record with shared timestamps and the list of channel records,
+        use split_channels() to get single channel records.
+        """
         timestamp_start = time.time_ns()
-        data = self._read_data(ch=ch, num=num, raw=raw)
+        waveforms = self._read_channels_codes(channels, num=num, raw=raw)
         timestamp_stop = time.time_ns()
         return {
             "timestamp_start": timestamp_start,
             "timestamp_stop": timestamp_stop,
-            "ch": ch,
             "time_resolution": self.time_resolution,
             "sampling_rate": self.sampling_rate,
-            "data": data
+            "channels": [self._channel_record(ch, data, y_increment, y_origin, volts=volts)
+                         for ch, (data, y_increment, y_origin) in zip(channels, waveforms)]
         }
 
+    def set_volts_buffers(self, buffers_num=1, dtype="float64"):
+        """
+        Sets up reusable output buffers for conversion to volts.
+        Each channel gets a ring of buffers_num preallocated arrays of given dtype, so the volts data
+        of a record stays valid until buffers_num more records of the same channel are read.
+        With buffers_num=0 a new array is allocated for every record.
+        """
+        self.volts_dtype = np.dtype(dtype)
+        self.volts_buffers_num = buffers_num
+        self.volts_buffers = dict()
+        self.volts_buffer_index = dict()
+
+    def _volts_buffer(self, ch, points):
+        if self.volts_buffers_num < 1:
+            return np.empty(points, dtype=self.volts_dtype)
+        buffers = self.volts_buffers.setdefault(ch, [None] * self.volts_buffers_num)
+        i = self.volts_buffer_index.get(ch, 0)
+        self.volts_buffer_index[ch] = (i + 1) % self.volts_buffers_num
+        if buffers[i] is None or buffers[i].shape[0] != points:
+            buffers[i] = np.empty(points, dtype=self.volts_dtype)
+        return buffers[i]
+
+    def _channel_record(self, ch, data, y_increment, y_origin, volts=True):
+        conversion_start = time.time_ns()
+        record = {"ch": ch}
+        if volts:
+            record["data"] = codes_to_volts(data, y_increment, y_origin, out=self._volts_buffer(ch, data.shape[0]))
+        else:
+            record["data"] = data
+            record["y_increment"] = y_increment
+            record["y_origin"] = y_origin
+            record["y_zero"] = ADC_ZERO
+        record["conversion_time"] = time.time_ns() - conversion_start if volts else 0
+        return record
+
+    def _read_channels_codes(self, channels, num=-1, raw=False):
+        return [self._read_codes(ch=ch, num=num, raw=raw) for ch in channels]
+
     def _read_data(self, ch=1, num=-1, raw=False):
+        data, y_increment, y_origin = self._read_codes(ch=ch, num=num, raw=raw)
+        if data is None:
+            return None
+        return codes_to_volts(data, y_increment, y_origin)
+
+    def _read_codes(self, ch=1, num=-1, raw=False):
         if ch > 0:
             if num > 0:
-                return np.zeros(num)
-            return np.zeros(self.buffer_size)
-        return None
+                return np.full(num, ADC_ZERO, dtype=np.uint8), 1.0, 0.0
+            return np.full(self.buffer_size, ADC_ZERO, dtype=np.uint8), 1.0, 0.0
+        return None, None, None
+
+    def close(self):
+        pass
@@ -0,0 +1,194 @@
+import time
+
+import numpy as np
+
+from .basic_dso import DSO, ADC_ZERO
+
+
+class SimulatedDSO(DSO):
+    """
+    Simulated DSO for running the acquisition loop without hardware.
+
+    Physical triggers arrive as a Poisson process with the given trigger_rate (1/s),
+    force_trig() triggers the acquisition after force_latency seconds.
+    After the trigger the status is T'D for the record time plus td_time seconds,
+    then the DSO re-arms (WAIT) in RUN mode or stops (STOP) in SINGLE mode.
+    Each DSO command takes command_latency seconds plus byte_latency seconds for every transferred byte.
+    Waveforms are double exponential pulses at the trigger position plus gaussian noise,
+    forced triggers capture the noise only.
+    """
+
+    # Number of horizontal divisions on the DSO screen
+    DIVISIONS = 12
+    # ADC codes per vertical division
+    CODES_PER_DIV = 25
+
+    def __init__(self, trigger_rate=10.0, force_latency=1e-3, td_time=5e-3, command_latency=1e-3, byte_latency=1e-7,
+                 pulse_amplitude=0.1, pulse_rise=5e-9, pulse_decay=50e-9, noise=2e-3, points=None, seed=None,
+                 serial="n/a"):
+        super().__init__()
+        self.serial = serial
+        self.trigger_rate = trigger_rate
+        self.force_latency = force_latency
+        self.td_time = td_time
+        self.command_latency = command_latency
+        self.byte_latency = byte_latency
+        self.pulse_amplitude = pulse_amplitude
+        self.pulse_rise = pulse_rise
+        self.pulse_decay = pulse_decay
+        self.noise = noise
+        self.points = points
+        self.rng = np.random.default_rng(seed)
+        self.v_scale = dict()
+        self.running = False
+        self.single = False
+        self.trigger_time = None
+        self.forced = False
+        self.acquisition_forced = True
+        self.acquisitions_num = 0
+        self.waveforms = dict()
+        self.commands = 0
+        self.bytes_read = 0
+
+    @property
+    def instrument_data(self):
+        return {
+            "brand": "Simulated DSO",
+            "model": "SIM",
+            "sn": self.serial,
+            "firmware": "0.1"
+        }
+
+    def _command(self, bytes_num=0):
+        """
+        Simulates the USB transaction latency.
+        """
+        self.commands += 1
+        self.bytes_read += bytes_num
+        delay = self.command_latency + bytes_num * self.byte_latency
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def record_time(self):
+        return self.buffer_size * self.time_resolution
+
+    def _arm(self, now):
+        """
+        Schedules the next physical trigger.
+        """
+        self.running = True
+        self.forced = False
+        if self.trigger_rate > 0:
+            self.trigger_time = now + self.rng.exponential(1.0 / self.trigger_rate)
+        else:
+            self.trigger_time = None
+
+    def _update(self):
+        """
+        Advances the trigger state machine to the current time and returns the status.
+        """
+        while self.running:
+            now = time.monotonic()
+            if self.trigger_time is None or now < self.trigger_time:
+                return "WAIT"
+            acquisition_end = self.trigger_time + self.record_time + self.td_time
+            if now < acquisition_end:
+                return "T'D"
+            # the acquisition is complete, its waveforms are generated on first read
+            self.acquisitions_num += 1
+            self.acquisition_forced = self.forced
+            self.waveforms = dict()
+            if self.single:
+                self.running = False
+                self.single = False
+            else:
+                self._arm(acquisition_end)
+        return "STOP"
+
+    def get_v_scale(self, ch=1):
+        if ch > 0:
+            return self.v_scale.get(ch, 1.0)
+        return None
+
+    def set_v_scale(self, ch=1, new_v_scale=1.0):
+        self._command()
+        self.v_scale[ch] = new_v_scale
+
+    def get_trigger_status(self):
+        self._command()
+        return self._update()
+
+    def force_trig(self):
+        self._command()
+        status = self._update()
+        if status == "WAIT":
+            trigger_time = time.monotonic() + self.force_latency
+            if self.trigger_time is None or trigger_time < self.trigger_time:
+                self.trigger_time = trigger_time
+                self.forced = True
+
+    def set_run(self):
+        self._command()
+        if not self.running:
+            self._arm(time.monotonic())
+        self.single = False
+
+    def set_stop(self):
+        self._command()
+        self._update()
+        self.running = False
+        self.single = False
+
+    def set_single(self):
+        self._command()
+        self._update()
+        self._arm(time.monotonic())
+        self.single = True
+
+    def set_points_num(self, points_num=600):
+        self._command()
+
+    def get_points_num(self):
+        return self.buffer_size
+
+    @property
+    def buffer_size(self):
+        if self.points:
+            return self.points
+        return max(1, int(round(self.DIVISIONS * self.time_scale * self.sampling_rate)))
+
+    @property
+    def time_resolution(self):
+        return 1.0 / self.sampling_rate
+
+    def y_increment(self, ch=1):
+        return self.get_v_scale(ch) / self.CODES_PER_DIV
+
+    def generate_waveform(self, ch=1, forced=False):
+        """
+        Generates the waveform of the last acquisition as raw ADC codes.
+        """
+        n = self.buffer_size
+        volts = self.rng.normal(0.0, self.noise, n) if self.noise > 0 else np.zeros(n)
+        if not forced:
+            t = (np.arange(n) - n // 2) * self.time_resolution
+            t = np.clip(t, 0.0, None)
+            pulse = np.exp(-t / self.pulse_decay) - np.exp(-t / self.pulse_rise)
+            peak = pulse.max()
+            if peak > 0:
+                volts += pulse * (self.pulse_amplitude * self.rng.uniform(0.2, 1.0) / peak)
+        codes = np.rint(ADC_ZERO - volts / self.y_increment(ch))
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def _read_codes(self, ch=1, num=-1, raw=False):
+        if ch < 1:
+            return None, None, None
+        self._update()
+        if ch not in self.waveforms:
+            self.waveforms[ch] = self.generate_waveform(ch, forced=self.acquisition_forced)
+        data = self.waveforms[ch]
+        if num > 0:
+            data = data[:num]
+        self._command(data.shape[0])
+        return data, self.y_increment(ch), 0.0
@@ -0,0 +1,85 @@
+import time
+
+
+class SingleShotCycle:
+    """
+    State machine of the single shot acquisition shared by the blocking and the asyncio acquisition loops.
+
+    The loops query the trigger status and pass it to step(), which returns the action to take:
+     - READ: the acquisition is complete, read the waveforms, re-arm with :SINGLE and call rearmed(),
+       then call completed() when the record is handed over,
+     - FORCE: force the trigger and call forced(),
+     - None: wait before the next status query.
+    The loops differ only in how the DSO commands and the waits are executed.
+    """
+
+    READ = "READ"
+    FORCE = "FORCE"
+
+    def __init__(self, poller, record_time, trigger_force=False, force_interval=0.0, metrics=None):
+        self.poller = poller
+        self.record_time = record_time
+        self.trigger_force = trigger_force
+        self.force_interval = force_interval
+        self.metrics = metrics
+        self.armed_time = time.time_ns()
+        self.last_record = self.armed_time
+        self.acquisition_start = None
+        self.acquisition_stop = None
+        self.is_forced = False
+
+    def step(self, trigger_status):
+        """
+        Updates the state with the trigger status and returns the action to take.
+        """
+        self.poller.update(trigger_status)
+        if trigger_status == "STOP":
+            # commands are executed in order, so STOP after :SINGLE means the acquisition is complete
+            self.acquisition_stop = time.time_ns()
+            if self.acquisition_start is None:
+                self.acquisition_start = self.acquisition_stop
+            return self.READ
+        if trigger_status == "WAIT":
+            if self.trigger_force and not self.is_forced:
+                since_armed = (time.time_ns() - self.armed_time) / 1e9
+                if since_armed >= self.force_interval:
+                    return self.FORCE
+                # armed for physical triggers too, so they are noticed within max_interval
+                self.poller.expect(min(self.force_interval - since_armed, self.poller.max_interval))
+        elif trigger_status == "T'D":
+            if self.acquisition_start is None:
+                self.acquisition_start = time.time_ns()
+            self.poller.expect(self.record_time)
+        return None
+
+    def forced(self):
+        """
+        Marks the trigger forced, the record is expected after the record time.
+        """
+        self.is_forced = True
+        self.poller.expect(self.record_time)
+        if self.metrics is not None:
+            self.metrics.inc("forced_triggers")
+
+    def rearmed(self):
+        """
+        Marks the DSO re-armed with :SINGLE, collects the trigger_rearm metric.
+        """
+        self.armed_time = time.time_ns()
+        if self.metrics is not None:
+            self.metrics.observe_ns("trigger_rearm", self.armed_time - self.acquisition_stop)
+
+    def completed(self):
+        """
+        Closes the acquisition cycle, collects the loop and dead time metrics and returns the loop time in ns.
+        """
+        now = time.time_ns()
+        loop_time = now - self.last_record
+        self.last_record = now
+        if self.metrics is not None:
+            self.metrics.inc("triggers")
+            self.metrics.observe_ns("loop_time", loop_time)
+            self.metrics.observe_ns("dead_time", loop_time - self.record_time * 1e9)
+        self.acquisition_start = None
+        self.is_forced = False
+        return loop_time
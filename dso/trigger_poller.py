@@ -0,0 +1,116 @@
+import time
+
+
+class TriggerPoller:
+    """
+    Paces the trigger status queries of the acquisition loop.
+
+    Modes:
+     - busy: query the status again immediately,
+     - fixed: wait the fixed interval between queries,
+     - backoff: wait min_interval, multiply the wait by factor after each query up to max_interval,
+       reset to min_interval when the status changes,
+     - predict: sleep until the expected time of the next status change announced with expect(),
+       e.g. the end of the record or the next force trigger, then poll as in backoff mode.
+
+    With td_window set to the shortest time the DSO reports T'D after a trigger, the waits while the DSO is armed
+    (status other than STOP) are capped at half of it, so the T'D status does not fall between two queries.
+    The cap is skipped when it is shorter than the measured status query latency, it could not help then.
+    """
+
+    MODES = ("busy", "fixed", "backoff", "predict")
+
+    def __init__(self, mode="backoff", interval=1e-3, min_interval=2e-4, max_interval=5e-3, factor=2.0,
+                 td_window=0.0):
+        if mode not in self.MODES:
+            raise ValueError(f"Trigger poll mode must be one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.td_window = td_window
+        self.current_interval = min_interval
+        self.expected = None
+        self.status = None
+        self.polls = 0
+        self.triggers = 0
+        self.trigger_polls = 0
+        self.max_trigger_polls = 0
+        # moving average of the time between the queries beyond the waits
+        self.query_latency = None
+        self.last_update = None
+        self.last_delay = 0.0
+
+    def expect(self, delay):
+        """
+        Announces the next status change expected in delay seconds.
+        """
+        self.expected = time.monotonic() + delay
+
+    def next_delay(self):
+        """
+        Returns the wait in seconds before the next status query according to the mode.
+        """
+        delay = None
+        if self.mode == "busy":
+            delay = 0.0
+        elif self.mode == "fixed":
+            delay = self.limit(self.interval)
+        elif self.mode == "predict" and self.expected is not None:
+            expected_delay = self.expected - time.monotonic()
+            self.expected = None
+            if expected_delay > 0:
+                delay = self.limit(expected_delay)
+        if delay is None:
+            delay = self.limit(self.current_interval)
+            self.current_interval = min(self.current_interval * self.factor, self.max_interval)
+        self.last_delay = delay
+        return delay
+
+    def limit(self, delay):
+        """
+        Caps the wait at half of td_window while the DSO is armed, unless the cap is below the query latency.
+        """
+        cap = self.td_window / 2
+        if cap > 0 and self.status != "STOP" and cap > (self.query_latency or 0.0):
+            return min(delay, cap)
+        return delay
+
+    def wait(self):
+        """
+        Waits before the next status query according to the mode.
+        """
+        delay = self.next_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, status):
+        """
+        Counts the status query, measures the query latency and resets the backoff on status change.
+        """
+        now = time.monotonic()
+        if self.last_update is not None:
+            latency = max(0.0, now - self.last_update - self.last_delay)
+            self.query_latency = latency if self.query_latency is None else \
+                self.query_latency + 0.1 * (latency - self.query_latency)
+        self.last_update = now
+        self.polls += 1
+        self.trigger_polls += 1
+        if status != self.status:
+            self.current_interval = self.min_interval
+            if status == "T'D":
+                self.triggers += 1
+                self.max_trigger_polls = max(self.max_trigger_polls, self.trigger_polls)
+                self.trigger_polls = 0
+            self.status = status
+
+    @property
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "polls": self.polls,
+            "triggers": self.triggers,
+            "polls_per_trigger": self.polls / self.triggers if self.triggers else None,
+            "max_polls_per_trigger": self.max_trigger_polls
+        }
@@ -0,0 +1,167 @@
+import argparse
+import contextlib
+import copy
+import itertools
+import json
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+from ruamel.yaml import YAML
+
+from dso.simulated_dso import SimulatedDSO
+from dso_stream import (configure_scope, setup_streamer, setup_writer, setup_poller, setup_volts_buffers,
+                        acquisition_loop)
+from stream_metrics import Metrics
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DSO streaming throughput and dead time benchmark "
+                                                 "using the simulated DSO")
+    parser.add_argument("config", nargs="?", default="config.yaml", help="base config YAML file")
+    parser.add_argument("--duration", type=float, default=10.0, help="duration of each case in seconds")
+    parser.add_argument("--points", type=int, nargs="+", default=[600, 16384], help="record lengths")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 2], help="channel counts")
+    parser.add_argument("--storage", nargs="+", default=["volts", "raw"], help="storage modes")
+    parser.add_argument("--writer", type=int, nargs="+", default=[0, 64], help="writer queue sizes")
+    parser.add_argument("--flush", nargs="+", default=["records", "close"], help="flush modes")
+    parser.add_argument("--poll", nargs="+", default=["backoff"], help="trigger poll modes")
+    parser.add_argument("--mode", nargs="+", default=["run"], help="acquisition modes")
+    parser.add_argument("--trigger-rate", type=float, default=0.0,
+                        help="simulated physical trigger rate in 1/s, 0 for forced triggers only")
+    parser.add_argument("--stall-timeout", type=float, default=1.0,
+                        help="case without a record for this many seconds is reported as stalled")
+    parser.add_argument("--output", default="", help="JSON output file, stdout if omitted")
+    return parser.parse_args()
+
+
+def load_config(config_file):
+    with open(config_file, "r") as stream:
+        yaml = YAML(typ="safe")
+        return dict(yaml.load(stream))
+
+
+def case_config(base_config, data_dir, points, channels_num, storage_mode, writer_queue_size, flush_mode,
+                poll_mode, acquisition_mode, trigger_rate):
+    config = copy.deepcopy(base_config)
+    config["data_dir"] = data_dir
+    config["driver"] = "SIM"
+    config["storage_mode"] = storage_mode
+    config["writer_queue_size"] = writer_queue_size
+    config["flush_mode"] = flush_mode
+    config["acquisition_mode"] = acquisition_mode
+    config.setdefault("trigger_poll", {})
+    config["trigger_poll"]["mode"] = poll_mode
+    config["trigger_force"] = 1
+    config["trigger_force_interval"] = 0
+    config.setdefault("simulation", {})
+    config["simulation"]["points"] = points
+    config["simulation"]["trigger_rate"] = trigger_rate
+    template = config["channels"][0]
+    config["channels"] = [dict(template, ch=ch, label=f"CH{ch:d}") for ch in range(1, channels_num + 1)]
+    return config
+
+
+def quantiles_ms(histogram):
+    if histogram.count == 0:
+        return {"p50": None, "p99": None}
+    return {"p50": histogram.quantile(0.5) * 1e3, "p99": histogram.quantile(0.99) * 1e3}
+
+
+def run_case(config, duration, stall_timeout=1.0):
+    """
+    Runs the acquisition loop against the simulated DSO for the given duration and returns the results.
+    The case is stalled if no record was saved for stall_timeout seconds, its throughput is not reported.
+    """
+    scope = SimulatedDSO(**config["simulation"])
+    configure_scope(scope, config)
+    metrics = Metrics()
+    streamer = setup_streamer(config, scope, metrics=metrics)
+    writer = setup_writer(config, streamer)
+    poller = setup_poller(config)
+    setup_volts_buffers(config, scope)
+    start = time.monotonic()
+    acquisition_loop(scope, writer, config, duration=duration, metrics=metrics, poller=poller,
+                     verbose=False)
+    # loop times are the intervals between the saves from the loop start
+    loop_time = metrics.histogram("loop_time")
+    max_gap = max(loop_time.max or 0.0, time.monotonic() - start - loop_time.sum)
+    writer.close_file()
+    elapsed = time.monotonic() - start
+    scope.close()
+    triggers = metrics.counter("triggers").value
+    if max_gap > stall_timeout:
+        return {
+            "stalled": True,
+            "elapsed_s": elapsed,
+            "triggers": triggers,
+            "max_record_gap_s": max_gap,
+            "trigger_poll": poller.stats,
+        }
+    file_size = sum(filename.stat().st_size for filename in streamer.files)
+    sample_bytes = 1 if config["storage_mode"] == "raw" else np.dtype(config.get("volts_dtype", "float64")).itemsize
+    payload_size = triggers * len(config["channels"]) * scope.buffer_size * sample_bytes
+    result = {
+        "stalled": False,
+        "elapsed_s": elapsed,
+        "triggers": triggers,
+        "records": triggers * len(config["channels"]),
+        "triggers_per_s": triggers / elapsed,
+        "records_per_s": triggers * len(config["channels"]) / elapsed,
+        "file_bytes": file_size,
+        "mb_per_s": file_size / elapsed / 1e6,
+        "payload_bytes": payload_size,
+        "payload_mb_per_s": payload_size / elapsed / 1e6,
+        "max_record_gap_s": max_gap,
+        "commands_per_trigger": scope.commands / triggers if triggers else None,
+        "dead_time_ms": quantiles_ms(metrics.histogram("dead_time")),
+        "stages_ms": {name: quantiles_ms(histogram) for name, histogram in metrics.histograms.items()},
+    }
+    result["trigger_poll"] = poller.stats
+    if writer is not streamer:
+        result["writer"] = writer.stats
+    return result
+
+
+def main():
+    args = parse_args()
+    base_config = load_config(args.config)
+    results = []
+    cases = itertools.product(args.points, args.channels, args.storage, args.writer, args.flush, args.poll, args.mode)
+    for points, channels_num, storage_mode, writer_queue_size, flush_mode, poll_mode, acquisition_mode in cases:
+        case = {
+            "points": points,
+            "channels": channels_num,
+            "storage_mode": storage_mode,
+            "writer_queue_size": writer_queue_size,
+            "flush_mode": flush_mode,
+            "poll_mode": poll_mode,
+            "acquisition_mode": acquisition_mode,
+        }
+        print("Running", case, file=sys.stderr)
+        with tempfile.TemporaryDirectory() as data_dir:
+            config = case_config(base_config, data_dir, points, channels_num, storage_mode, writer_queue_size,
+                                 flush_mode, poll_mode, acquisition_mode, args.trigger_rate)
+            with contextlib.redirect_stdout(sys.stderr):
+                result = run_case(config, args.duration, args.stall_timeout)
+        if result["stalled"]:
+            print(f"STALLED: no record for {result['max_record_gap_s']:.3f} s", file=sys.stderr)
+        results.append({**case, **result})
+    report = {
+        "created": datetime.now().isoformat(),
+        "duration_s": args.duration,
+        "trigger_rate": args.trigger_rate,
+        "simulation": base_config.get("simulation", {}),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
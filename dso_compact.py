@@ -0,0 +1,250 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from dso.basic_dso import ADC_ZERO
+from hdf5_streamer import INDEX_FIELDS, RAW_INDEX_FIELDS, COMPRESSIONS, compression_filter, data_chunks
+
+
+# Per-record attributes of the legacy layout stored in the index datasets of the compact layout
+RECORD_FIELDS = ("timestamp_start", "timestamp_stop", "time_resolution", "sampling_rate")
+SCALE_FIELDS = ("y_increment", "y_origin", "y_zero")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Converts legacy HDF5 files with one dataset per record "
+                                                 "to the compact records layout")
+    parser.add_argument("inputs", nargs="+", help="legacy HDF5 data files or directories with them")
+    parser.add_argument("-o", "--output-dir", required=True, help="directory for the compacted files")
+    parser.add_argument("--compression", default="none", choices=COMPRESSIONS, help="waveforms compression filter")
+    parser.add_argument("--level", type=int, default=0, help="compression level, 0 for the codec default")
+    parser.add_argument("--no-codes", action="store_true",
+                        help="keep waveforms in volts even if the scale attributes allow uint8 ADC codes")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="convert again the already compacted files")
+    return parser.parse_args()
+
+
+def input_files(inputs):
+    files = []
+    for name in inputs:
+        path = Path(name)
+        if path.is_dir():
+            files.extend(sorted(path.glob("*.hdf5")))
+        else:
+            files.append(path)
+    return files
+
+
+def is_legacy(f):
+    """
+    Legacy channel groups hold one dataset per record named by timestamp_start.
+    """
+    channels = [group for name, group in f.items() if name.startswith("CH")]
+    return bool(channels) and all("data" not in group for group in channels)
+
+
+def record_codes(dataset):
+    """
+    Returns the record as uint8 ADC codes if the scale attributes allow exact conversion, None otherwise.
+    """
+    if not all(field in dataset.attrs for field in SCALE_FIELDS):
+        return None
+    data = dataset[()]
+    if data.dtype == np.uint8:
+        return data
+    y_increment = float(dataset.attrs["y_increment"])
+    y_origin = float(dataset.attrs["y_origin"])
+    y_zero = float(dataset.attrs["y_zero"])
+    codes = np.rint(y_zero - (data + y_origin) / y_increment)
+    if codes.min() < 0 or codes.max() > 255:
+        return None
+    if not np.allclose((y_zero - codes) * y_increment - y_origin, data, rtol=1e-9, atol=1e-12):
+        return None
+    return codes.astype(np.uint8)
+
+
+def record_volts(dataset):
+    data = dataset[()]
+    if data.dtype != np.uint8 or "y_increment" not in dataset.attrs:
+        return data
+    return ((float(dataset.attrs["y_zero"]) - data) * float(dataset.attrs["y_increment"])
+            - float(dataset.attrs["y_origin"]))
+
+
+def extra_fields(datasets):
+    """
+    Returns the names of per-record attributes not covered by the index datasets, present in all records.
+    """
+    known = set(RECORD_FIELDS) | set(SCALE_FIELDS)
+    names = set()
+    for dataset in datasets:
+        names.update(name for name in dataset.attrs if name not in known)
+    for name in sorted(names):
+        if not all(name in dataset.attrs for dataset in datasets):
+            raise ValueError(f"Attribute {name} is missing in some records of {datasets[0].parent.name}")
+    return sorted(names)
+
+
+def compact_channel(src_group, dst_group, compression, level, codes):
+    """
+    Writes the records of the legacy channel group as the compact records layout, returns the storage mode.
+    """
+    dst_group.attrs.update(src_group.attrs)
+    names = sorted(src_group.keys(), key=int)
+    datasets = [src_group[name] for name in names]
+    extra = extra_fields(datasets)
+    raw = codes and len(datasets) > 0 and all(record_codes(dataset) is not None for dataset in datasets)
+    if raw:
+        dtype, fillvalue, index_fields = np.uint8, ADC_ZERO, {**INDEX_FIELDS, **RAW_INDEX_FIELDS}
+    else:
+        dtype = np.result_type(*(dataset.dtype for dataset in datasets)) if datasets else np.float64
+        if dtype == np.uint8:
+            dtype = np.float64
+        fillvalue, index_fields = np.nan, INDEX_FIELDS
+    n = len(datasets)
+    width = max((dataset.shape[0] for dataset in datasets), default=0)
+    chunks = data_chunks(width, dtype, compression)
+    data = dst_group.create_dataset("data", shape=(n, width), maxshape=(None, None), dtype=dtype,
+                                    chunks=chunks, fillvalue=fillvalue, **compression_filter(compression, level))
+    if raw:
+        data.attrs["y_zero"] = ADC_ZERO
+    index = {name: np.zeros(n, dtype=field_dtype) for name, field_dtype in index_fields.items()}
+    for name in extra:
+        index[name] = np.array([datasets[0].attrs[name]] * n)
+    for start in range(0, n, chunks[0]):
+        batch = datasets[start:start + chunks[0]]
+        rows = np.full((len(batch), width), fillvalue, dtype=dtype)
+        for i, dataset in enumerate(batch):
+            record = record_codes(dataset) if raw else record_volts(dataset)
+            if raw:
+                # the codes are stored against ADC_ZERO, the origin absorbs other zero levels
+                y_zero = float(dataset.attrs["y_zero"])
+                index["y_increment"][start + i] = dataset.attrs["y_increment"]
+                index["y_origin"][start + i] = (float(dataset.attrs["y_origin"])
+                                                - (y_zero - ADC_ZERO) * float(dataset.attrs["y_increment"]))
+            rows[i, :record.shape[0]] = record
+            index["points"][start + i] = record.shape[0]
+            for name in RECORD_FIELDS:
+                index[name][start + i] = dataset.attrs[name]
+            for name in extra:
+                index[name][start + i] = dataset.attrs[name]
+        data[start:start + len(batch)] = rows
+    for name, values in index.items():
+        if values.dtype.kind in "OU":
+            values = values.astype(h5py.string_dtype())
+        dst_group.create_dataset(name, data=values, maxshape=(None,), chunks=(4096,))
+    return "raw" if raw else "volts"
+
+
+def verify_channel(src_group, dst_group):
+    """
+    Compares every record and its attributes of the compacted channel group with the legacy one.
+    """
+    names = sorted(src_group.keys(), key=int)
+    data = dst_group["data"]
+    if data.shape[0] != len(names):
+        raise ValueError(f"{dst_group.name}: {data.shape[0]} records instead of {len(names)}")
+    raw = "y_increment" in dst_group
+    chunk_records = data.chunks[0] if data.chunks else max(1, len(names))
+    index = dict()
+    for name, dataset in dst_group.items():
+        if name != "data":
+            index[name] = dataset.asstr()[()] if h5py.check_string_dtype(dataset.dtype) else dataset[()]
+    for start in range(0, len(names), chunk_records):
+        rows = data[start:start + chunk_records]
+        for i, name in enumerate(names[start:start + chunk_records]):
+            dataset = src_group[name]
+            points = int(index["points"][start + i])
+            if points != dataset.shape[0]:
+                raise ValueError(f"{dst_group.name}/{name}: {points} points instead of {dataset.shape[0]}")
+            row = rows[i, :points]
+            if raw:
+                row = (ADC_ZERO - row.astype(np.float64)) * index["y_increment"][start + i] \
+                      - index["y_origin"][start + i]
+            if not np.allclose(row, record_volts(dataset), rtol=1e-9, atol=1e-12, equal_nan=True):
+                raise ValueError(f"{dst_group.name}/{name}: waveform does not match")
+            for field, value in dataset.attrs.items():
+                if field in SCALE_FIELDS:
+                    continue
+                if index[field][start + i] != value:
+                    raise ValueError(f"{dst_group.name}/{name}: attribute {field} does not match")
+    for field, value in src_group.attrs.items():
+        if not np.array_equal(dst_group.attrs[field], value):
+            raise ValueError(f"{dst_group.name}: group attribute {field} does not match")
+
+
+def compact_file(src, dst, compression="none", level=0, codes=True, force=False):
+    """
+    Converts one legacy file. The output is written to a temporary file, verified and renamed,
+    so an interrupted conversion leaves no output and is simply repeated on the next run.
+    """
+    if dst.exists() and dst.samefile(src):
+        return {"file": src.name, "status": "output is the input file, skipped"}
+    if dst.exists() and not force:
+        return {"file": src.name, "status": "done before"}
+    tmp = dst.with_name(dst.name + ".tmp")
+    modes = set()
+    try:
+        with h5py.File(src, "r") as f:
+            if not is_legacy(f):
+                return {"file": src.name, "status": "not legacy"}
+            with h5py.File(tmp, "w") as out:
+                out.attrs.update(f.attrs)
+                for name, item in f.items():
+                    if name.startswith("CH"):
+                        modes.add(compact_channel(item, out.create_group(name), compression, level, codes))
+                    else:
+                        f.copy(item, out, name=name)
+                out.attrs["storage_mode"] = "raw" if modes == {"raw"} else "volts" if modes == {"volts"} else "mixed"
+                out.attrs["compression"] = compression
+                out.attrs["compacted_from"] = src.name
+            with h5py.File(tmp, "r") as out:
+                for name, item in f.items():
+                    if name.startswith("CH"):
+                        verify_channel(item, out[name])
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, dst)
+    return {
+        "file": src.name,
+        "status": "compacted",
+        "storage_mode": sorted(modes),
+        "input_mb": src.stat().st_size / 1e6,
+        "output_mb": dst.stat().st_size / 1e6,
+    }
+
+
+def main():
+    args = parse_args()
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    files = input_files(args.inputs)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(compact_file, src, output_dir / src.name, args.compression, args.level,
+                               not args.no_codes, args.force): src for src in files}
+        for future in as_completed(futures):
+            src = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"{src.name}: FAILED {e}", file=sys.stderr)
+                continue
+            if result["status"] == "compacted":
+                print(f"{result['file']}: {result['input_mb']:.1f} MB -> {result['output_mb']:.1f} MB "
+                      f"({', '.join(result['storage_mode'])})")
+            else:
+                print(f"{result['file']}: {result['status']}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
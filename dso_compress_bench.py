@@ -0,0 +1,106 @@
+import argparse
+import json
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from dso.basic_dso import ADC_ZERO
+from dso.simulated_dso import SimulatedDSO
+from hdf5_streamer import COMPRESSIONS, compression_filter, data_chunks
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compression ratio and speed of HDF5 filters on captured waveforms")
+    parser.add_argument("files", nargs="*", help="HDF5 data files written by dso_stream.py, "
+                                                "simulated waveforms are used if omitted")
+    parser.add_argument("--codecs", nargs="+", default=list(COMPRESSIONS), help="compression filters to test")
+    parser.add_argument("--level", type=int, default=0, help="compression level, 0 for the codec default")
+    parser.add_argument("--records", type=int, default=1000, help="maximal number of records per channel")
+    parser.add_argument("--points", type=int, default=16384, help="record length of simulated waveforms")
+    parser.add_argument("--storage", default="raw", help="storage mode of simulated waveforms: volts or raw")
+    parser.add_argument("--output", default="", help="JSON output file")
+    return parser.parse_args()
+
+
+def load_waveforms(files, records):
+    """
+    Returns the waveforms datasets of all channels of the data files as (name, array) pairs.
+    """
+    waveforms = []
+    for filename in files:
+        with h5py.File(filename, "r") as f:
+            for name, group in f.items():
+                if name.startswith("CH") and "data" in group and group["data"].shape[0] > 0:
+                    waveforms.append((f"{Path(filename).name}/{name}", group["data"][:records]))
+    return waveforms
+
+
+def simulate_waveforms(records, points, storage_mode):
+    scope = SimulatedDSO(points=points, noise=2e-3, seed=0)
+    scope.v_scale[1] = 0.05
+    codes = np.stack([scope.generate_waveform(1, forced=bool(i % 2)) for i in range(records)])
+    if storage_mode == "raw":
+        return [("simulated/CH1", codes)]
+    return [("simulated/CH1", (ADC_ZERO - codes.astype(np.float64)) * scope.y_increment(1))]
+
+
+def measure(data, compression, level, tmp_dir):
+    """
+    Writes the waveforms with the compression filter and reads them back.
+    """
+    filename = Path(tmp_dir) / f"{compression}.hdf5"
+    write_start = time.perf_counter()
+    with h5py.File(filename, "w") as f:
+        # same chunking as the Streamer, padding of the last chunk is included in the ratio
+        dataset = f.create_dataset("data", data=data, maxshape=(None, None),
+                                   chunks=data_chunks(data.shape[1], data.dtype, compression),
+                                   **compression_filter(compression, level))
+        f.flush()
+        stored = dataset.id.get_storage_size()
+    write_time = time.perf_counter() - write_start
+    read_start = time.perf_counter()
+    with h5py.File(filename, "r") as f:
+        restored = f["data"][()]
+    read_time = time.perf_counter() - read_start
+    filename.unlink()
+    if not np.array_equal(restored, data, equal_nan=True):
+        raise RuntimeError(f"{compression} round trip does not match")
+    return {
+        "ratio": data.nbytes / stored,
+        "write_mb_per_s": data.nbytes / write_time / 1e6,
+        "read_mb_per_s": data.nbytes / read_time / 1e6,
+    }
+
+
+def main():
+    args = parse_args()
+    if args.files:
+        waveforms = load_waveforms(args.files, args.records)
+    else:
+        waveforms = simulate_waveforms(args.records, args.points, args.storage)
+    results = []
+    print(f"{'waveforms':32s} {'codec':10s} {'ratio':>8s} {'write MB/s':>11s} {'read MB/s':>10s}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, data in waveforms:
+            for compression in args.codecs:
+                try:
+                    result = measure(data, compression, args.level, tmp_dir)
+                except (ModuleNotFoundError, ValueError) as e:
+                    print(f"{name:32s} {compression:10s} skipped: {e}", file=sys.stderr)
+                    continue
+                print(f"{name:32s} {compression:10s} {result['ratio']:8.2f} {result['write_mb_per_s']:11.1f} "
+                      f"{result['read_mb_per_s']:10.1f}")
+                results.append({"waveforms": name, "dtype": str(data.dtype), "shape": list(data.shape),
+                                "compression": compression, **result})
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": datetime.now().isoformat(), "level": args.level, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
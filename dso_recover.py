@@ -0,0 +1,118 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from hdf5_streamer import Streamer, COMPRESSIONS
+from hdf5_streamer.journal import scan_journal
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Salvages the valid records of DSO journal files left after a crash "
+                                                 "and writes them to HDF5 files")
+    parser.add_argument("inputs", nargs="+", help="journal segment files or directories with them")
+    parser.add_argument("-o", "--output-dir",
+                        help="directory for the recovered files, the journal directory if omitted")
+    parser.add_argument("--compression", default="none", choices=COMPRESSIONS, help="waveforms compression filter")
+    parser.add_argument("--level", type=int, default=0, help="compression level, 0 for the codec default")
+    return parser.parse_args()
+
+
+def journal_runs(inputs):
+    """
+    Groups the journal segment files by run name, segments are sorted by number.
+    """
+    files = []
+    for name in inputs:
+        path = Path(name)
+        if path.is_dir():
+            files.extend(path.glob("*.journal"))
+        else:
+            files.append(path)
+    runs = dict()
+    for path in sorted(files):
+        runs.setdefault(path.stem.rsplit("_", 1)[0], []).append(path)
+    return runs
+
+
+def run_settings(run, segments):
+    """
+    Returns the Streamer settings saved by the journal writer, None if the run file is missing.
+    """
+    run_file = segments[0].with_name(f"{run}_journal.json")
+    if run_file.is_file():
+        with open(run_file, "r") as f:
+            return json.load(f)
+    return None
+
+
+def recover_run(run, segments, output_dir, compression="none", level=0):
+    scans = []
+    for path in segments:
+        try:
+            header, frames, stats = scan_journal(path)
+        except (ValueError, OSError) as e:
+            print(f"{path.name}: FAILED {e}", file=sys.stderr)
+            continue
+        print(f"{path.name}: {stats['valid']} valid, {stats['corrupt']} corrupt, {stats['empty']} empty frames")
+        scans.append((header, frames))
+    frames = [frame for _, segment_frames in scans for frame in segment_frames]
+    if not frames:
+        print(f"{run}: no records to recover")
+        return 0
+    frames.sort(key=lambda frame: frame[0])
+    settings = run_settings(run, segments)
+    if settings is None:
+        # guessed from the journal headers and the frames
+        raw = all(header["dtype"].name == "uint8" for header, _ in scans)
+        settings = {
+            "storage_mode": "raw" if raw else "volts",
+            "volts_dtype": "float64" if raw else scans[0][0]["dtype"].name,
+            "channels_num": max(channel_data["ch"] for _, channel_data in frames),
+            "sampling_rate": frames[0][1]["sampling_rate"],
+            "time_scale": 0.0,
+            "time_resolution": frames[0][1]["time_resolution"],
+            "record_length": max(header["max_points"] for header, _ in scans),
+            "dso_information": None,
+            "channel_attrs": {},
+        }
+    streamer = Streamer(
+        working_dir=output_dir,
+        channels_num=settings["channels_num"],
+        sampling_rate=settings["sampling_rate"],
+        time_scale=settings["time_scale"],
+        time_resolution=settings["time_resolution"],
+        storage_mode=settings["storage_mode"],
+        record_length=settings["record_length"],
+        flush_mode="close",
+        volts_dtype=settings["volts_dtype"],
+        compression=compression,
+        compression_level=level,
+        run_name=f"{run}_recovered",
+    )
+    if settings["dso_information"]:
+        streamer.save_dso_information(settings["dso_information"])
+    for ch, attrs in settings["channel_attrs"].items():
+        for name, value in attrs.items():
+            streamer.set_channel_attr(int(ch), name, value)
+    for _, channel_data in frames:
+        streamer.save_channel_data(channel_data)
+    streamer.close_file()
+    print(f"{run}: recovered {len(frames)} records to", ", ".join(str(filename) for filename in streamer.files))
+    return len(frames)
+
+
+def main():
+    args = parse_args()
+    runs = journal_runs(args.inputs)
+    if not runs:
+        print("No journal files found", file=sys.stderr)
+        sys.exit(1)
+    for run, segments in runs.items():
+        output_dir = Path(args.output_dir) if args.output_dir else segments[0].parent
+        output_dir.mkdir(parents=True, exist_ok=True)
+        recover_run(run, segments, output_dir, args.compression, args.level)
+
+
+if __name__ == "__main__":
+    main()
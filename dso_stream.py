@@ -2,9 +2,23 @@ import sys
 import time
 from pathlib import Path
 from ruamel.yaml import YAML
+import numpy as np
 
-from hdf5_streamer import Streamer
+from hdf5_streamer import Streamer, BackgroundWriter, JournalWriter
 from dso.agilent_dso import DSO3000, DSO1000
+from dso.basic_dso import split_channels
+from dso.simulated_dso import SimulatedDSO
+from dso.single_shot import SingleShotCycle
+from dso.trigger_poller import TriggerPoller
+from live_stream import Publisher
+from processing import ChangeGate, FeatureExtractor, Accumulator
+from stream_metrics import Metrics
+
+
+# run: free running DSO stopped for each readout, single: DSO re-armed with :SINGLE after each readout
+ACQUISITION_MODES = ("run", "single")
+# Minimal wait for the T'D status after force trigger in seconds, covers the DSO force latency
+FORCE_TIMEOUT = 0.1
 
 
 def print_usage(error=""):
@@ -26,17 +40,52 @@ def read_config():
     return dictionary
 
 
-def setup_streamer(config, scope):
-    working_dir = Path(config["data_dir"])
-    print("Setting WORKING DIR to", working_dir.absolute())
-    if not working_dir.is_dir():
+def setup_metrics(config):
+    metrics_config = config.get("metrics", {})
+    return Metrics(
+        jsonl_file=metrics_config.get("jsonl_file", ""),
+        prometheus_file=metrics_config.get("prometheus_file", ""),
+        export_interval=metrics_config.get("export_interval", 10.0)
+    )
+
+
+def working_dir(config):
+    path = Path(config["data_dir"])
+    print("Setting WORKING DIR to", path.absolute())
+    if not path.is_dir():
         raise NotADirectoryError
-    streamer = Streamer(
-        working_dir=working_dir,
-        channels_num=len(config["channels"]),
+    return path
+
+
+def streamer_options(config):
+    """
+    Returns the Streamer storage options from config.
+    """
+    return dict(
         sampling_rate=config["sampling_rate"],
         time_scale=config["time_scale"],
-        time_resolution=scope.time_resolution
+        storage_mode=config.get("storage_mode", "volts"),
+        flush_mode=config.get("flush_mode", "records"),
+        flush_records=config.get("flush_records", 1),
+        flush_interval=config.get("flush_interval", 5.0),
+        volts_dtype=config.get("volts_dtype", "float64"),
+        rotate_size=int(config.get("rotate_size_mb", 0) * 1e6),
+        rotate_records=config.get("rotate_records", 0),
+        rotate_interval=config.get("rotate_interval", 0),
+        compression=config.get("compression", "none"),
+        compression_level=config.get("compression_level", 0),
+        swmr=bool(config.get("swmr", 0)),
+    )
+
+
+def setup_streamer(config, scope, metrics=None):
+    streamer = Streamer(
+        working_dir=working_dir(config),
+        channels_num=len(config["channels"]),
+        time_resolution=scope.time_resolution,
+        record_length=scope.buffer_size,
+        metrics=metrics,
+        **streamer_options(config)
     )
     for channel in config["channels"]:
         streamer.set_channel_label(channel["ch"], channel["label"])
@@ -44,12 +93,80 @@ def setup_streamer(config, scope):
     return streamer
 
 
+def setup_processing(config, streamer, metrics=None):
+    """
+    Puts the enabled processing stages between the writer and the Streamer.
+    """
+    sink = streamer
+    accumulate_config = config.get("accumulate", {})
+    if accumulate_config.get("mode", "none") != "none":
+        # accumulators replace the stored records, so they are next to the Streamer
+        sink = Accumulator(sink, mode=accumulate_config["mode"], records=accumulate_config.get("records", 1000),
+                           interval=accumulate_config.get("interval", 0.0),
+                           keep_records=bool(accumulate_config.get("keep_records", 0)), metrics=metrics)
+    gate_config = config.get("gate", {})
+    if gate_config.get("enabled", 0):
+        template = np.load(gate_config["template"]) if gate_config.get("template") else None
+        sink = ChangeGate(sink, baseline_records=gate_config.get("baseline_records", 32),
+                          peak_sigma=gate_config.get("peak_sigma", 6.0), rms_factor=gate_config.get("rms_factor", 1.5),
+                          template=template, correlation=gate_config.get("correlation", 0.8),
+                          keep_every=gate_config.get("keep_every", 100), metrics=metrics)
+    features_config = config.get("features", {})
+    if features_config.get("enabled", 0):
+        # features of all records, including the ones dropped by the gate
+        sink = FeatureExtractor(sink, batch_records=features_config.get("batch_records", 64),
+                                baseline_points=features_config.get("baseline_points", 16),
+                                polarity=features_config.get("polarity", "positive"),
+                                workers=features_config.get("workers", 0),
+                                pool_min_points=features_config.get("pool_min_points", 1_000_000), metrics=metrics)
+    return sink
+
+
+def setup_volts_buffers(config, scope):
+    # records stay referenced in the writer queue, so the ring must outlive the queue
+    queue_size = config.get("writer_queue_size", 64)
+    scope.set_volts_buffers(buffers_num=queue_size + 2, dtype=config.get("volts_dtype", "float64"))
+
+
+def setup_writer(config, streamer):
+    if config.get("journal", 0):
+        return JournalWriter(streamer, journal_size=int(config.get("journal_size_mb", 64) * 1e6),
+                             sync_records=config.get("journal_sync_records", 0),
+                             keep_journal=bool(config.get("keep_journal", 0)))
+    queue_size = config.get("writer_queue_size", 64)
+    if queue_size > 0:
+        return BackgroundWriter(streamer, queue_size=queue_size, overflow=config.get("writer_overflow", "block"))
+    return streamer
+
+
+def setup_publisher(config, writer):
+    publish_config = config.get("publish", {})
+    if publish_config.get("address"):
+        return Publisher(writer, address=publish_config["address"],
+                         buffer_frames=publish_config.get("buffer_frames", 64))
+    return writer
+
+
+def setup_poller(config):
+    poll_config = config.get("trigger_poll", {})
+    return TriggerPoller(
+        mode=poll_config.get("mode", "backoff"),
+        interval=poll_config.get("interval", 1e-3),
+        min_interval=poll_config.get("min_interval", 2e-4),
+        max_interval=poll_config.get("max_interval", 5e-3),
+        factor=poll_config.get("factor", 2.0),
+        td_window=poll_config.get("td_window", 0.0)
+    )
+
+
 def get_scope(config):
     scope = None
     if config["driver"] == "DSO3000":
-        scope = DSO3000()
+        scope = DSO3000(char_delay=config.get("char_delay", "auto"), serial=config.get("serial") or None)
     elif config["driver"] == "DSO1000":
-        scope = DSO1000()
+        scope = DSO1000(serial=config.get("serial") or None)
+    elif config["driver"] == "SIM":
+        scope = SimulatedDSO(serial=config.get("serial") or "n/a", **config.get("simulation", {}))
     return scope
 
 
@@ -75,25 +192,204 @@ def configure_scope(scope, config):
     scope.set_trigger_sweep(config["trigger_sweep"])
 
 
-def save_channels_data(scope, streamer, config, acquisition_start, acquisition_stop):
-    channels_read_time = 0
+def save_channels_data(scope, streamer, config, acquisition_start, acquisition_stop, metrics=None, verbose=True,
+                       rearm=None):
+    """
+    Reads the configured channels and saves the records.
+    rearm is called right after the waveforms transfer, before the records are saved.
+    """
     channels_save_time = 0
-    for channel in config["channels"]:
-        channel_data = scope.read_data(channel["ch"], num=scope.get_points_num(), raw=True)
-        channels_read_time += channel_data['timestamp_stop'] - channel_data['timestamp_start']
-        print(
-            f"========> CH{channel['ch']} reading {channel_data['data'].shape[0]} points took {(channel_data['timestamp_stop'] - channel_data['timestamp_start']) / 1e6} ms")
+    record = scope.read_channels([channel["ch"] for channel in config["channels"]], num=scope.get_points_num(),
+                                 raw=True, volts=config.get("storage_mode", "volts") != "raw")
+    if rearm is not None:
+        rearm()
+    channels_read_time = record['timestamp_stop'] - record['timestamp_start']
+    if metrics is not None:
+        metrics.observe_ns("usb_read", channels_read_time)
+    if verbose:
+        print(f"========> reading {len(record['channels'])} channels took {channels_read_time / 1e6} ms")
+    for channel_data in split_channels(record):
+        if metrics is not None:
+            metrics.observe_ns("conversion", channel_data["conversion_time"])
         channel_data["timestamp_start"] = acquisition_start
         channel_data["timestamp_stop"] = acquisition_stop
         save_start = time.time_ns()
         streamer.save_channel_data(channel_data)
         save_time = time.time_ns() - save_start
-        print(
-            f"========> CH{channel['ch']} saving {channel_data['data'].shape[0]} points took {save_time / 1e6} ms")
+        if metrics is not None:
+            metrics.observe_ns("save", save_time)
+            metrics.inc("records")
+        if verbose:
+            print(
+                f"========> CH{channel_data['ch']} saving {channel_data['data'].shape[0]} points took {save_time / 1e6} ms")
         channels_save_time += save_time
     return channels_read_time, channels_save_time
 
 
+def update_writer_metrics(writer, metrics):
+    if isinstance(writer, Publisher):
+        metrics.set("publisher_subscribers", len(writer.subscriptions))
+        metrics.set("publisher_dropped", writer.dropped)
+        writer = writer.sink
+    if isinstance(writer, (BackgroundWriter, JournalWriter)):
+        metrics.set("writer_pending", writer.pending)
+        metrics.set("writer_queued", writer.queued)
+        metrics.set("writer_dropped", writer.dropped)
+
+
+def poll_trigger_status(scope, writer, metrics=None):
+    if metrics is None:
+        return scope.get_trigger_status()
+    poll_start = time.time_ns()
+    trigger_status = scope.get_trigger_status()
+    metrics.observe_ns("trigger_poll", time.time_ns() - poll_start)
+    metrics.inc("trigger_polls")
+    update_writer_metrics(writer, metrics)
+    metrics.export_if_due()
+    return trigger_status
+
+
+def acquisition_loop(scope, writer, config, duration=None, metrics=None, poller=None, verbose=True):
+    """
+    Runs the acquisition loop until KeyboardInterrupt or for the duration in seconds if given.
+    Per-stage latencies and counters are collected to metrics if given.
+    Trigger status queries are paced by the poller, busy polling is used if no poller is given.
+    If the DSO re-arms without the T'D status of a forced trigger being seen, it is stopped and forced again
+    after the record time plus trigger_force_interval (at least FORCE_TIMEOUT), counted as missed_triggers metric.
+    """
+    if config.get("acquisition_mode", "run") == "single":
+        return single_acquisition_loop(scope, writer, config, duration=duration, metrics=metrics, poller=poller,
+                                       verbose=verbose)
+    if poller is None:
+        poller = TriggerPoller(mode="busy")
+    sampling_interval = config["trigger_force_interval"]
+    need_to_save = False
+    forced = False
+    acquisition_start = 0
+    trigger_forced_time = 0
+    trigger_set_time = 0
+    last_save = time.time_ns()
+    loop_stop = None if duration is None else time.monotonic() + duration
+    channels_read_time = 0
+    channels_save_time = 0
+    scope.set_stop()
+    while loop_stop is None or time.monotonic() < loop_stop:
+        trigger_status = poll_trigger_status(scope, writer, metrics)
+        poller.update(trigger_status)
+        if trigger_status == "WAIT":
+            if need_to_save:
+                if verbose:
+                    print("===> NEED TO SAVE DATA")
+                scope.set_stop()
+                scope.set_points_num(scope.buffer_size)
+                record_time = scope.buffer_size * scope.time_resolution * 1e9
+                # print("RES", scope.time_resolution)
+                acquisition_stop = time.time_ns()
+                # acq_time = acquisition_stop - acquisition_start
+                save_time = time.time_ns()
+                acq_loop_time = save_time - last_save
+                dead_time = acq_loop_time - record_time
+                last_save = save_time
+                # python_time = acq_loop_time - trigger_set_time - acq_time - channels_read_time - channels_save_time
+                if verbose:
+                    print(f"LOOP TIME: {acq_loop_time / 1e6} ms, RECORD LENGTH={record_time / 1e3} us, DEAD TIME={dead_time / 1e6} ms ({dead_time / record_time * 100}%)")
+                # print(f"TRIGGER SET time: {trigger_set_time / 1e6} ms = {trigger_set_time / acq_loop_time * 100}%")
+                # print(f"ACQ time: {acq_time / 1e6} ms = {acq_time / acq_loop_time * 100}%")
+                # print(f"READ time: {channels_read_time / 1e6} ms = {channels_read_time / acq_loop_time * 100}%")
+                # print(f"SAVE time: {channels_save_time / 1e6} ms = {channels_save_time / acq_loop_time * 100}%")
+                # print(f"PYTHON overhead: {python_time / 1e6} ms = {python_time / acq_loop_time * 100}%")
+                #
+                #
+                # print(f"======>Acquisition took {acq_time / 1e6} ms, record_time={record_time / 1e6} ms")
+                # print("========> SAVING DATA")
+                channels_read_time, channels_save_time = save_channels_data(scope, writer, config,
+                                                                            acquisition_start, acquisition_stop,
+                                                                            metrics=metrics, verbose=verbose)
+                if metrics is not None:
+                    metrics.inc("triggers")
+                    metrics.observe_ns("loop_time", acq_loop_time)
+                    metrics.observe_ns("dead_time", dead_time)
+                need_to_save = False
+                if verbose:
+                    print()
+            elif forced:
+                since_forced = (time.time_ns() - trigger_forced_time) / 1e9
+                if since_forced > scope.buffer_size * scope.time_resolution + max(float(sampling_interval),
+                                                                                  FORCE_TIMEOUT):
+                    # T'D of the forced trigger was missed and the DSO re-armed, it is stopped to be forced again
+                    if verbose:
+                        print("===> TRIGGER MISSED")
+                    scope.set_stop()
+                    forced = False
+                    if metrics is not None:
+                        metrics.inc("missed_triggers")
+        elif trigger_status == "STOP":
+            # print("RES", scope.time_resolution)
+            if config["trigger_force"]:
+                since_forced = (time.time_ns() - trigger_forced_time) / 1e9
+                if since_forced > float(sampling_interval):
+                    scope.set_run()
+                    if verbose:
+                        print("===> FORCE TRIGGER")
+                    trigger_forced_time = time.time_ns()
+                    scope.force_trig()
+                    forced = True
+                    poller.expect(scope.buffer_size * scope.time_resolution)
+                    if metrics is not None:
+                        metrics.inc("forced_triggers")
+                else:
+                    poller.expect(float(sampling_interval) - since_forced)
+            else:
+                scope.set_run()
+        elif trigger_status == "T'D" and not need_to_save:
+            if config["trigger_force"]:
+                trigger_set_time = time.time_ns() - trigger_forced_time
+            acquisition_start = time.time_ns()
+            need_to_save = True
+            forced = False
+            # the DSO re-arms after the record is acquired
+            poller.expect(scope.buffer_size * scope.time_resolution)
+        poller.wait()
+
+
+def single_acquisition_loop(scope, writer, config, duration=None, metrics=None, poller=None, verbose=True):
+    """
+    Runs the acquisition in single shot mode until KeyboardInterrupt or for the duration in seconds if given.
+    The DSO stops after each acquisition and is re-armed with :SINGLE right after the waveforms transfer,
+    so saving the records overlaps with the next acquisition. The points number is set once in configure_scope.
+    Time from the end of the acquisition (STOP status) to the re-arm is collected as trigger_rearm metric.
+    """
+    if poller is None:
+        poller = TriggerPoller(mode="busy")
+    # timing is fixed for the run, the values are cached by the DSO driver
+    record_time = scope.buffer_size * scope.time_resolution
+    loop_stop = None if duration is None else time.monotonic() + duration
+    scope.set_stop()
+    scope.set_single()
+    cycle = SingleShotCycle(poller, record_time, trigger_force=config["trigger_force"],
+                            force_interval=float(config["trigger_force_interval"]), metrics=metrics)
+    while loop_stop is None or time.monotonic() < loop_stop:
+        action = cycle.step(poll_trigger_status(scope, writer, metrics))
+        if action == cycle.READ:
+            def rearm():
+                scope.set_single()
+                cycle.rearmed()
+
+            save_channels_data(scope, writer, config, cycle.acquisition_start, cycle.acquisition_stop,
+                               metrics=metrics, verbose=verbose, rearm=rearm)
+            acq_loop_time = cycle.completed()
+            if verbose:
+                print(f"LOOP TIME: {acq_loop_time / 1e6} ms, RECORD LENGTH={record_time * 1e6} us, "
+                      f"RE-ARM={(cycle.armed_time - cycle.acquisition_stop) / 1e6} ms")
+                print()
+        elif action == cycle.FORCE:
+            if verbose:
+                print("===> FORCE TRIGGER")
+            scope.force_trig()
+            cycle.forced()
+        poller.wait()
+
+
 def main():
     try:
         config = read_config()
@@ -114,77 +410,60 @@ def main():
         return
     print("Connected to DSO:", scope.instrument_data)
     configure_scope(scope, config)
+    if config.get("acquisition_mode", "run") not in ACQUISITION_MODES:
+        print_usage(error=f"Acquisition mode must be one of {', '.join(ACQUISITION_MODES)}")
+        return
+    try:
+        poller = setup_poller(config)
+    except ValueError as e:
+        print_usage(error=str(e))
+        return
 
+    metrics = setup_metrics(config)
     try:
-        streamer = setup_streamer(config, scope)
+        streamer = setup_streamer(config, scope, metrics=metrics)
     except NotADirectoryError:
         print("==> Directory does not exist")
         return
     except PermissionError:
         print("==> Directory is not writable (Permission Error)")
         return
+    try:
+        sink = setup_processing(config, streamer, metrics=metrics)
+    except ValueError as e:
+        streamer.close_file()
+        print_usage(error=str(e))
+        return
+    writer = setup_writer(config, sink)
+    try:
+        output = setup_publisher(config, writer)
+    except (OSError, ValueError) as e:
+        writer.close_file()
+        print("==> Can not start the publisher:", e)
+        return
+    setup_volts_buffers(config, scope)
 
-    sampling_interval = config["trigger_force_interval"]
     print("Start streaming data")
-    need_to_save = False
-    acquisition_start = 0
-    trigger_forced_time = 0
-    trigger_set_time = 0
-    last_save = time.time_ns()
-    channels_read_time = 0
-    channels_save_time = 0
-    scope.set_stop()
     try:
-        while True:
-            trigger_status = scope.get_trigger_status()
-            if trigger_status == "WAIT":
-                if need_to_save:
-                    print("===> NEED TO SAVE DATA")
-                    scope.set_stop()
-                    scope.set_points_num(scope.buffer_size)
-                    record_time = scope.buffer_size * scope.time_resolution * 1e9
-                    # print("RES", scope.time_resolution)
-                    acquisition_stop = time.time_ns()
-                    # acq_time = acquisition_stop - acquisition_start
-                    save_time = time.time_ns()
-                    acq_loop_time = save_time - last_save
-                    dead_time = acq_loop_time - record_time
-                    last_save = save_time
-                    # python_time = acq_loop_time - trigger_set_time - acq_time - channels_read_time - channels_save_time
-                    print(f"LOOP TIME: {acq_loop_time / 1e6} ms, RECORD LENGTH={record_time / 1e3} us, DEAD TIME={dead_time / 1e6} ms ({dead_time / record_time * 100}%)")
-                    # print(f"TRIGGER SET time: {trigger_set_time / 1e6} ms = {trigger_set_time / acq_loop_time * 100}%")
-                    # print(f"ACQ time: {acq_time / 1e6} ms = {acq_time / acq_loop_time * 100}%")
-                    # print(f"READ time: {channels_read_time / 1e6} ms = {channels_read_time / acq_loop_time * 100}%")
-                    # print(f"SAVE time: {channels_save_time / 1e6} ms = {channels_save_time / acq_loop_time * 100}%")
-                    # print(f"PYTHON overhead: {python_time / 1e6} ms = {python_time / acq_loop_time * 100}%")
-                    #
-                    #
-                    # print(f"======>Acquisition took {acq_time / 1e6} ms, record_time={record_time / 1e6} ms")
-                    # print("========> SAVING DATA")
-                    channels_read_time, channels_save_time = save_channels_data(scope, streamer, config,
-                                                                                acquisition_start, acquisition_stop)
-                    need_to_save = False
-                    print()
-            elif trigger_status == "STOP":
-                # print("RES", scope.time_resolution)
-                if config["trigger_force"]:
-                    if (time.time_ns() - trigger_forced_time) / 1e9 > float(sampling_interval):
-                        scope.set_run()
-                        print("===> FORCE TRIGGER")
-                        trigger_forced_time = time.time_ns()
-                        scope.force_trig()
-                else:
-                    scope.set_run()
-            elif trigger_status == "T'D" and not need_to_save:
-                if config["trigger_force"]:
-                    trigger_set_time = time.time_ns() - trigger_forced_time
-                acquisition_start = time.time_ns()
-                need_to_save = True
+        acquisition_loop(scope, output, config, metrics=metrics, poller=poller, verbose=config.get("verbose", 1))
     except KeyboardInterrupt:
         print()
         print("Stop streaming data")
         scope.close()
-        streamer.close_file()
+        output.close_file()
+        if output is not writer:
+            print("Publisher stats:", output.stats)
+        if writer is not sink:
+            print("Writer stats:", writer.stats)
+        stage = sink
+        while stage is not streamer:
+            print(f"{type(stage).__name__} stats:", stage.stats)
+            stage = stage.sink
+        update_writer_metrics(output, metrics)
+        metrics.export()
+        print("Trigger poll stats:", poller.stats)
+        if hasattr(scope, "transport_stats"):
+            print("Transport stats:", scope.transport_stats)
         print("Bye, bye!")
         pass
 
@@ -0,0 +1,163 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dso.async_dso import AsyncDSO
+from dso.basic_dso import split_channels
+from dso_stream import (print_usage, read_config, setup_metrics, setup_streamer, setup_processing, setup_publisher,
+                        setup_poller, get_scope, configure_scope)
+
+
+async def broadcast(records, queues):
+    """
+    Passes every record of the async generator to each stage queue, None marks the end of the stream.
+    """
+    async for record in records:
+        for queue in queues:
+            await queue.put(record)
+    for queue in queues:
+        await queue.put(None)
+
+
+async def storage_stage(queue, streamer, executor, metrics=None):
+    """
+    Saves the records with the Streamer on its own executor thread, closes the file at the end of the stream.
+    On cancellation the records left in the queue are saved before the file is closed.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            record = await queue.get()
+            if record is None:
+                return
+            for channel_data in split_channels(record):
+                save_start = time.time_ns()
+                await loop.run_in_executor(executor, streamer.save_channel_data, channel_data)
+                if metrics is not None:
+                    metrics.observe_ns("save", time.time_ns() - save_start)
+                    metrics.inc("records")
+    finally:
+        records = []
+        while not queue.empty():
+            record = queue.get_nowait()
+            if record is not None:
+                records.extend(split_channels(record))
+        await loop.run_in_executor(executor, save_and_close, streamer, records)
+
+
+def save_and_close(streamer, records):
+    for channel_data in records:
+        streamer.save_channel_data(channel_data)
+    streamer.close_file()
+
+
+async def metrics_stage(queue, storage_queue, metrics, executor, verbose=True):
+    """
+    Collects per-record metrics and exports them, the export files are written on the executor thread.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            record = await queue.get()
+            if record is None:
+                return
+            for channel in record["channels"]:
+                metrics.observe_ns("conversion", channel["conversion_time"])
+            metrics.set("storage_pending", storage_queue.qsize())
+            if verbose:
+                print(f"Record {record['timestamp_start']}: {len(record['channels'])} channels, "
+                      f"{storage_queue.qsize()} pending")
+            if time.monotonic() - metrics.last_export >= metrics.export_interval:
+                await loop.run_in_executor(executor, metrics.export)
+    finally:
+        await loop.run_in_executor(executor, metrics.export)
+
+
+async def stream(config, scope, streamer, metrics, poller, duration=None, verbose=True):
+    """
+    Runs acquisition, storage and metrics stages concurrently under the running event loop.
+    """
+    queue_size = max(1, config.get("writer_queue_size", 64))
+    # records stay referenced in the storage queue, so the ring must outlive the queue
+    scope.set_volts_buffers(buffers_num=queue_size + 2, dtype=config.get("volts_dtype", "float64"))
+    device = AsyncDSO(scope, name=config.get("driver", "DSO"))
+    storage_queue = asyncio.Queue(maxsize=queue_size)
+    metrics_queue = asyncio.Queue(maxsize=queue_size)
+    storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+    metrics_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics")
+    records = device.records([channel["ch"] for channel in config["channels"]], raw=True,
+                             volts=config.get("storage_mode", "volts") != "raw",
+                             trigger_force=bool(config["trigger_force"]),
+                             force_interval=float(config["trigger_force_interval"]),
+                             poller=poller, duration=duration, metrics=metrics)
+    try:
+        await asyncio.gather(
+            broadcast(records, (storage_queue, metrics_queue)),
+            storage_stage(storage_queue, streamer, storage_executor, metrics),
+            metrics_stage(metrics_queue, storage_queue, metrics, metrics_executor, verbose=verbose),
+        )
+    finally:
+        await records.aclose()
+        await device.close()
+        storage_executor.shutdown(wait=True)
+        metrics_executor.shutdown(wait=True)
+
+
+def main():
+    try:
+        config = read_config()
+    except FileNotFoundError:
+        print_usage(error="Config file not found")
+        return
+    except ValueError:
+        print_usage(error="Can not parse config file")
+        return
+    try:
+        scope = get_scope(config)
+    except KeyError:
+        print_usage(error="No scope driver in config file.\nCorrect config example:\ndriver: DSO3000")
+        return
+    if scope is None:
+        print_usage(error=f"Wrong scope driver `{config['driver']}` in config file.")
+        return
+    print("Connected to DSO:", scope.instrument_data)
+    configure_scope(scope, config)
+    try:
+        poller = setup_poller(config)
+    except ValueError as e:
+        print_usage(error=str(e))
+        return
+    metrics = setup_metrics(config)
+    try:
+        streamer = setup_streamer(config, scope, metrics=metrics)
+    except NotADirectoryError:
+        print("==> Directory does not exist")
+        return
+    except PermissionError:
+        print("==> Directory is not writable (Permission Error)")
+        return
+    try:
+        streamer = setup_processing(config, streamer, metrics=metrics)
+    except ValueError as e:
+        streamer.close_file()
+        print_usage(error=str(e))
+        return
+    try:
+        streamer = setup_publisher(config, streamer)
+    except (OSError, ValueError) as e:
+        streamer.close_file()
+        print("==> Can not start the publisher:", e)
+        return
+
+    print("Start streaming data")
+    try:
+        asyncio.run(stream(config, scope, streamer, metrics, poller, verbose=config.get("verbose", 1)))
+    except KeyboardInterrupt:
+        print()
+        print("Stop streaming data")
+        print("Trigger poll stats:", poller.stats)
+        print("Bye, bye!")
+
+
+if __name__ == "__main__":
+    main()
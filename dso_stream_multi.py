@@ -0,0 +1,221 @@
+import multiprocessing
+import os
+import signal
+from pathlib import Path
+
+from hdf5_streamer import Streamer
+from dso_stream import (print_usage, read_config, setup_metrics, setup_poller, get_scope, configure_scope,
+                        setup_processing, setup_publisher, acquisition_loop, working_dir, streamer_options,
+                        ACQUISITION_MODES)
+
+
+class QueueSink:
+    """
+    Passes the records of the worker process to the shared writer process through the queue.
+    Has the save_channel_data / close_file interface of the Streamer.
+    """
+
+    def __init__(self, queue, index):
+        self.queue = queue
+        self.index = index
+
+    def save_channel_data(self, channel_data):
+        # the record is pickled later by the queue feeder thread, so it must not share reusable buffers
+        self.queue.put(("record", self.index, channel_data))
+
+    def close_file(self):
+        pass
+
+
+def scope_configs(config):
+    """
+    Returns the config of each scope listed in `scopes`, the scope entries override the top level settings.
+    """
+    base = {key: value for key, value in config.items() if key != "scopes"}
+    configs = []
+    for i, entry in enumerate(config["scopes"]):
+        scope_config = {**base, **entry}
+        scope_config["name"] = entry.get("name", f"DSO{i + 1:d}")
+        configs.append(scope_config)
+    return configs
+
+
+def scope_metrics_config(config):
+    """
+    Suffixes the metrics export files with the scope name, so the workers do not overwrite each other.
+    """
+    metrics_config = dict(config.get("metrics", {}))
+    for key in ("jsonl_file", "prometheus_file"):
+        if metrics_config.get(key):
+            path = Path(metrics_config[key])
+            metrics_config[key] = str(path.with_name(f"{path.stem}_{config['name']}{path.suffix}"))
+    return {**config, "metrics": metrics_config}
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def worker(index, config, queue):
+    """
+    Acquisition worker process of one scope, runs until SIGTERM.
+    SIGINT of the terminal is ignored, the main process stops the workers after saving what it has got.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        scope = get_scope(config)
+        if scope is None:
+            raise ValueError(f"Wrong scope driver `{config['driver']}`")
+        configure_scope(scope, config)
+        poller = setup_poller(config)
+    except Exception as e:
+        queue.put(("error", index, f"{type(e).__name__}: {e}"))
+        return
+    metrics = setup_metrics(scope_metrics_config(config))
+    queue.put(("info", index, {
+        "instrument": scope.instrument_data,
+        "time_resolution": scope.time_resolution,
+        "buffer_size": scope.buffer_size,
+    }))
+    try:
+        acquisition_loop(scope, QueueSink(queue, index), config, metrics=metrics, poller=poller,
+                         verbose=config.get("verbose", 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scope.close()
+        metrics.export()
+        queue.put(("done", index, poller.stats))
+
+
+def setup_shared_streamer(config, configs, infos):
+    """
+    Creates the Streamer of the run, the channels of all scopes are numbered consecutively in config order.
+    Returns the streamer and the map of (scope index, scope channel) to the file channel.
+    """
+    channel_map = dict()
+    for index, scope_config in enumerate(configs):
+        for channel in scope_config["channels"]:
+            channel_map[(index, channel["ch"])] = len(channel_map) + 1
+    streamer = Streamer(
+        working_dir=working_dir(config),
+        channels_num=len(channel_map),
+        time_resolution=infos[0]["time_resolution"],
+        record_length=max(info["buffer_size"] for info in infos.values()),
+        **streamer_options(config)
+    )
+    for index, scope_config in enumerate(configs):
+        info = infos[index]
+        for channel in scope_config["channels"]:
+            ch = channel_map[(index, channel["ch"])]
+            streamer.set_channel_label(ch, channel["label"])
+            streamer.set_channel_v_scale(ch, channel["v_scale"])
+            streamer.set_channel_attr(ch, "scope", scope_config["name"])
+            streamer.set_channel_attr(ch, "scope_model", info["instrument"]["model"])
+            streamer.set_channel_attr(ch, "scope_sn", info["instrument"]["sn"])
+            streamer.set_channel_attr(ch, "scope_channel", channel["ch"])
+            streamer.set_channel_attr(ch, "sampling_rate", scope_config["sampling_rate"])
+            streamer.set_channel_attr(ch, "time_scale", scope_config["time_scale"])
+            streamer.set_channel_attr(ch, "time_resolution", info["time_resolution"])
+    return setup_publisher(config, setup_processing(config, streamer)), channel_map
+
+
+def stop_workers(workers):
+    for process in workers:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+
+
+def main():
+    try:
+        config = read_config()
+    except FileNotFoundError:
+        print_usage(error="Config file not found")
+        return
+    except ValueError:
+        print_usage(error="Can not parse config file")
+        return
+    if not config.get("scopes"):
+        print_usage(error="No scopes list in config file")
+        return
+    configs = scope_configs(config)
+    for scope_config in configs:
+        if scope_config.get("acquisition_mode", "run") not in ACQUISITION_MODES:
+            print_usage(error=f"Acquisition mode must be one of {', '.join(ACQUISITION_MODES)}")
+            return
+    try:
+        working_dir(config)
+    except NotADirectoryError:
+        print("==> Directory does not exist")
+        return
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue(maxsize=max(1, config.get("writer_queue_size", 64)) * len(configs))
+    workers = [context.Process(target=worker, args=(index, scope_config, queue), name=scope_config["name"])
+               for index, scope_config in enumerate(configs)]
+    for process in workers:
+        process.start()
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            stopping = True
+            print()
+            print("Stop streaming data")
+            stop_workers(workers)
+
+    # keep saving the queued records until all the workers are done
+    signal.signal(signal.SIGINT, stop)
+
+    infos = dict()
+    running = len(workers)
+    streamer = None
+    channel_map = dict()
+    # records of the scopes started before the others are connected
+    pending = []
+    records = 0
+    print(f"Start streaming data from {len(workers)} scopes")
+    while running:
+        kind, index, payload = queue.get()
+        if kind == "record":
+            if streamer is None:
+                pending.append((index, payload))
+                continue
+            payload["ch"] = channel_map[(index, payload["ch"])]
+            streamer.save_channel_data(payload)
+            records += 1
+        elif kind == "info":
+            print(f"Connected to {configs[index]['name']}:", payload["instrument"])
+            infos[index] = payload
+            if len(infos) == len(workers):
+                try:
+                    streamer, channel_map = setup_shared_streamer(config, configs, infos)
+                except (OSError, ValueError) as e:
+                    print("==> Can not create the data file:", e)
+                    stop(None, None)
+                    continue
+                for index, channel_data in pending:
+                    channel_data["ch"] = channel_map[(index, channel_data["ch"])]
+                    streamer.save_channel_data(channel_data)
+                    records += 1
+                pending = []
+        elif kind == "error":
+            print(f"==> {configs[index]['name']} failed: {payload}")
+            running -= 1
+            stop(None, None)
+        elif kind == "done":
+            print(f"{configs[index]['name']} trigger poll stats:", payload)
+            running -= 1
+    for process in workers:
+        process.join()
+    if streamer is not None:
+        streamer.close_file()
+        print(f"Saved {records:d} records to", ", ".join(str(filename) for filename in streamer.files))
+    print("Bye, bye!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from live_stream import Subscriber
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Subscribes to the live stream of dso_stream.py "
+                                                 "and reports throughput, latency and lost frames")
+    parser.add_argument("address", nargs="?", default="unix:/tmp/dso_stream.sock",
+                        help="publisher address, unix:/path/to.sock or tcp:host:port")
+    parser.add_argument("--duration", type=float, default=0.0, help="seconds to run, 0 until interrupted")
+    parser.add_argument("--interval", type=float, default=1.0, help="report interval in seconds")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="processing time per frame in seconds to simulate a slow subscriber")
+    return parser.parse_args()
+
+
+class Report:
+    """
+    Frames, bytes, lost frames and latencies (publish to receive, acquisition stop to receive) of an interval.
+    """
+
+    def __init__(self, latency=True):
+        self.latency = latency
+        self.frames = 0
+        self.bytes = 0
+        self.lost = 0
+        self.transport = []
+        self.end_to_end = []
+        self.start = time.monotonic()
+
+    def add(self, record, received, lost):
+        self.frames += 1
+        self.bytes += record["data"].nbytes
+        self.lost += lost
+        if not self.latency:
+            return
+        self.transport.append(received - record["publish_time"])
+        self.end_to_end.append(received - record["timestamp_stop"])
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        summary = {
+            "frames": self.frames,
+            "lost": self.lost,
+            "frames_per_s": self.frames / elapsed,
+            "mb_per_s": self.bytes / elapsed / 1e6,
+        }
+        for name in ("transport", "end_to_end"):
+            if getattr(self, name):
+                latency = np.array(getattr(self, name)) / 1e6
+                summary[f"{name}_p50_ms"] = float(np.percentile(latency, 50))
+                summary[f"{name}_p99_ms"] = float(np.percentile(latency, 99))
+        return summary
+
+
+def main():
+    args = parse_args()
+    stop = time.monotonic() + args.duration if args.duration > 0 else None
+    report = Report()
+    # latencies of the whole run are not kept, the memory use stays fixed
+    total = Report(latency=False)
+    last_seq = None
+    try:
+        with Subscriber(args.address) as subscriber:
+            for record in subscriber:
+                received = time.time_ns()
+                # publisher sequence numbers are consecutive, the gaps are frames dropped for this subscriber
+                lost = 0 if last_seq is None else record["seq"] - last_seq - 1
+                last_seq = record["seq"]
+                report.add(record, received, lost)
+                total.add(record, received, lost)
+                if args.delay > 0:
+                    time.sleep(args.delay)
+                now = time.monotonic()
+                if now - report.start >= args.interval:
+                    print(json.dumps(report.summary()))
+                    report = Report()
+                if stop is not None and now >= stop:
+                    break
+    except KeyboardInterrupt:
+        pass
+    print("Total:", json.dumps(total.summary()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+import h5py
+
+from hdf5_streamer import VoltsView
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Follows new records of the HDF5 file written by dso_stream.py "
+                                                 "in SWMR mode")
+    parser.add_argument("path", help="HDF5 data file or run index JSON file of the rotated run")
+    parser.add_argument("--interval", type=float, default=0.5, help="polling interval in seconds")
+    parser.add_argument("--from-start", action="store_true", help="print the records already in the file")
+    return parser.parse_args()
+
+
+def open_swmr(filename, interval):
+    """
+    Opens the file for reading in SWMR mode, waits while the writer has not started SWMR yet.
+    """
+    while True:
+        try:
+            return h5py.File(filename, "r", libver="latest", swmr=True)
+        except OSError:
+            time.sleep(interval)
+
+
+def channel_groups(f):
+    return {name: group for name, group in f.items() if name.startswith("CH") and "data" in group}
+
+
+def print_record(name, index, volts, n):
+    timestamp = int(index["timestamp_start"][n])
+    points = int(index["points"][n])
+    waveform = volts[n, :points]
+    print(f"{name} #{n:d} {datetime.fromtimestamp(timestamp / 1e9).isoformat()} points={points:d} "
+          f"min={waveform.min():.4g} V max={waveform.max():.4g} V")
+
+
+def follow_file(filename, interval, from_start, finished):
+    """
+    Prints new records of the file until finished() returns True and no new records are left.
+    The datasets are refreshed in place, the file is not reopened.
+    """
+    with open_swmr(filename, interval) as f:
+        groups = channel_groups(f)
+        volts = {name: VoltsView(group) for name, group in groups.items()}
+        index = {name: {key: group[key] for key in ("timestamp_start", "points")} for name, group in groups.items()}
+        seen = {name: 0 if from_start else index[name]["points"].shape[0] for name in groups}
+        while True:
+            done = finished()
+            new_records = 0
+            for name in groups:
+                volts[name].refresh()
+                for dataset in index[name].values():
+                    dataset.refresh()
+                # index datasets are written after the waveform, so they limit the complete records
+                records = min(volts[name].shape[0], *(dataset.shape[0] for dataset in index[name].values()))
+                for n in range(seen[name], records):
+                    print_record(name, index[name], volts[name], n)
+                new_records += records - seen[name]
+                seen[name] = records
+            if done and new_records == 0:
+                return
+            time.sleep(interval)
+
+
+def read_index(index_file):
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+
+def wait_index(index_file, interval):
+    """
+    Reads the run index, waits while the writer has not created it yet.
+    """
+    while True:
+        try:
+            return read_index(index_file)
+        except FileNotFoundError:
+            time.sleep(interval)
+
+
+def follow_run(index_file, interval, from_start):
+    """
+    Follows the segments of the rotated run, switches to the next segment when it appears in the run index.
+    """
+    segment_num = 0 if from_start else len(wait_index(index_file, interval)["segments"]) - 1
+    while True:
+        segments = read_index(index_file)["segments"]
+        filename = index_file.parent / segments[segment_num]["file"]
+        print(f"==> {filename.name}")
+        follow_file(filename, interval, from_start, lambda: len(read_index(index_file)["segments"]) > segment_num + 1)
+        # the following segments are new
+        from_start = True
+        segment_num += 1
+
+
+def main():
+    args = parse_args()
+    path = Path(args.path)
+    try:
+        if path.suffix == ".json":
+            follow_run(path, args.interval, args.from_start)
+        else:
+            follow_file(path, args.interval, args.from_start, lambda: False)
+    except KeyboardInterrupt:
+        print()
+
+
+if __name__ == "__main__":
+    main()
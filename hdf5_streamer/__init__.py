@@ -1,63 +1,522 @@
 from pathlib import Path
+import json
+import os
+import queue
+import threading
 import time
 from datetime import datetime
+import numpy as np
 import h5py
 
+try:
+    import hdf5plugin
+except ModuleNotFoundError:
+    hdf5plugin = None
+
+from dso.basic_dso import ADC_ZERO
+from .writer import BackgroundWriter
+from .journal import JournalWriter
+from .reader import Reader
+
+
+# Per-record index datasets stored next to the waveforms of each channel
+INDEX_FIELDS = {
+    "timestamp_start": np.int64,
+    "timestamp_stop": np.int64,
+    "points": np.int64,
+    "time_resolution": np.float64,
+    "sampling_rate": np.float64,
+}
+# Additional per-record index datasets for raw ADC codes storage
+RAW_INDEX_FIELDS = {
+    "y_increment": np.float64,
+    "y_origin": np.float64,
+}
+# Target size of a single chunk of the waveforms dataset in bytes
+CHUNK_BYTES = 1 << 20
+# Smaller chunks for compressed waveforms, the partially filled chunk is compressed again on every flush
+COMPRESSED_CHUNK_BYTES = 1 << 16
+# records: flush every flush_records records, interval: every flush_interval seconds, close: on file close only
+FLUSH_MODES = ("records", "interval", "close")
+# Compression filters of the waveforms dataset, blosc_lz4 and lz4 need hdf5plugin package
+COMPRESSIONS = ("none", "gzip", "lzf", "blosc_lz4", "lz4")
+
+
+def compression_filter(compression="none", level=0):
+    """
+    Returns create_dataset keyword arguments for the compression filter.
+    Level 0 selects the default level of the codec, lzf and lz4 have no levels.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Compression must be one of {', '.join(COMPRESSIONS)}")
+    if compression == "none":
+        return {}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": level if level else 4, "shuffle": True}
+    if compression == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    if hdf5plugin is None:
+        raise ModuleNotFoundError(f"{compression} compression needs hdf5plugin package")
+    if compression == "blosc_lz4":
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=level if level else 5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    return dict(hdf5plugin.LZ4())
+
+
+def data_chunks(width, dtype, compression="none"):
+    """
+    Returns the chunk shape of the waveforms dataset holding about CHUNK_BYTES or COMPRESSED_CHUNK_BYTES.
+    """
+    chunk_bytes = CHUNK_BYTES if compression == "none" else COMPRESSED_CHUNK_BYTES
+    chunk_width = width if width > 0 else 1024
+    return max(1, chunk_bytes // (chunk_width * np.dtype(dtype).itemsize)), chunk_width
+
+
+class VoltsView:
+    """
+    Lazy read-only view of stored waveforms in volts.
+    Accepts either a channel group of the records layout or a single legacy waveform dataset.
+    Waveforms saved as raw ADC codes are converted to volts only for the requested slice.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, h5py.Group):
+            self.dataset = source["data"]
+            self.raw = "y_increment" in source
+            if self.raw:
+                self.y_increment = source["y_increment"]
+                self.y_origin = source["y_origin"]
+                self.y_zero = float(self.dataset.attrs["y_zero"])
+        else:
+            self.dataset = source
+            self.raw = "y_increment" in source.attrs
+            if self.raw:
+                self.y_increment = float(source.attrs["y_increment"])
+                self.y_origin = float(source.attrs["y_origin"])
+                self.y_zero = float(source.attrs["y_zero"])
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def refresh(self):
+        """
+        Updates the datasets to the records appended by the writer in SWMR mode.
+        """
+        self.dataset.refresh()
+        if self.raw and isinstance(self.y_increment, h5py.Dataset):
+            self.y_increment.refresh()
+            self.y_origin.refresh()
+
+    def __getitem__(self, item):
+        data = self.dataset[item]
+        if not self.raw:
+            return data
+        y_increment, y_origin = self.y_increment, self.y_origin
+        if isinstance(y_increment, h5py.Dataset):
+            rows = item[0] if isinstance(item, tuple) else item
+            y_increment, y_origin = y_increment[rows], y_origin[rows]
+            if data.ndim == 2:
+                y_increment, y_origin = y_increment[:, np.newaxis], y_origin[:, np.newaxis]
+        return (self.y_zero - data) * y_increment - y_origin
+
 
 class Streamer:
+    """
+    Appends DSO records to HDF5 files.
+
+    With any of rotate_size (bytes), rotate_records (triggers) or rotate_interval (seconds) set
+    the run is split into segment files `<run>_NNNN.hdf5`. The next segment is created ahead of time,
+    so the rollover only switches the file handles, the finished segment is closed and the following one
+    created on a rollover thread. Segments are listed with their time range and
+    record count in the run index file `<run>_index.json`, written when the first segment is created
+    and updated on every rollover and on close.
+
+    With swmr the files are written in HDF5 single writer multiple readers mode,
+    so they can be read with `h5py.File(filename, "r", libver="latest", swmr=True)` during the acquisition.
 
-    def __init__(self, working_dir="", channels_num=2, sampling_rate=1e9, time_scale=2e-9, time_resolution=2e-11):
+    The run is named by the creation time unless run_name is given.
+    """
+
+    def __init__(self, working_dir="", channels_num=2, sampling_rate=1e9, time_scale=2e-9, time_resolution=2e-11,
+                 storage_mode="volts", record_length=None, flush_mode="records", flush_records=1, flush_interval=5.0,
+                 volts_dtype="float64", rotate_size=0, rotate_records=0, rotate_interval=0, compression="none",
+                 compression_level=0, swmr=False, run_name=None, metrics=None):
         self.channels_num = channels_num
         self.sampling_rate = sampling_rate
         self.time_scale = time_scale
         self.time_resolution = time_resolution
+        self.storage_mode = storage_mode
+        self.record_length = record_length
+        self.volts_dtype = np.dtype(volts_dtype)
+        self.compression = compression
+        self.compression_filter = compression_filter(compression, compression_level)
+        if flush_mode not in FLUSH_MODES:
+            raise ValueError(f"Flush mode must be one of {', '.join(FLUSH_MODES)}")
+        self.flush_mode = flush_mode
+        self.flush_records = max(1, int(flush_records))
+        self.flush_interval = flush_interval
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        self.rotate_size = int(rotate_size)
+        self.rotate_records = int(rotate_records)
+        self.rotate_interval = rotate_interval
+        self.swmr = swmr
+        self.metrics = metrics
         self.working_dir = Path(working_dir)
         if not self.working_dir.is_dir():
             raise FileNotFoundError("Provide valid directory for data file storage")
+        self.run_name = run_name
+        self.segments = []
+        self.segment_start = time.monotonic()
+        self.next_segment = None
+        # finished segment files to close, set when the next segment is created
+        self.finished = queue.Queue()
+        self.segment_ready = threading.Event()
+        self.rollover_error = None
+        self.rollover_thread = None
+        # timestamp_start of the last write, and of the last records and table rows written
+        self.last_timestamp = None
+        self.last_timestamps = {"records": None, "rows": None}
+        self.dso_information = None
+        self.channel_attrs = {ch: dict() for ch in range(1, self.channels_num + 1)}
+        self.tables = dict()
         self.f = None
         self.dso = None
         self.channels = dict()
+        self.datasets = dict()
+        self.table_datasets = dict()
         self.create_file()
 
+    @property
+    def raw(self):
+        return self.storage_mode == "raw"
+
+    @property
+    def rotating(self):
+        return self.rotate_size > 0 or self.rotate_records > 0 or self.rotate_interval > 0
+
+    @property
+    def index_file(self):
+        return self.working_dir / f"{self.run_name}_index.json"
+
+    @property
+    def files(self):
+        """
+        Paths of the segment files written so far.
+        """
+        return [self.working_dir / segment["file"] for segment in self.segments]
+
     def create_file(self):
-        timestamp_ns = time.time_ns()
-        datetime_str = datetime.fromtimestamp(timestamp_ns / 1e9).strftime("%Y%m%d_%H%M%S")
-        filename = f"{datetime_str}.hdf5"
-        self.f = h5py.File(self.working_dir / filename, "w")
-        self.f.attrs["created"] = datetime.now().isoformat()
-        self.f.attrs["timestamp"] = timestamp_ns
-        self.dso = self.f.create_group("DSO")
+        if self.run_name is None:
+            self.run_name = datetime.fromtimestamp(time.time_ns() / 1e9).strftime("%Y%m%d_%H%M%S")
+        self.activate_segment(self.open_segment(0))
+        if self.rotating:
+            self.next_segment = self.open_segment(1)
+            self.segment_ready.set()
+            self.rollover_thread = threading.Thread(target=self._rollover, name="HDF5Rollover", daemon=True)
+            self.rollover_thread.start()
+        # the run can be opened by its index from the first segment on, also after a crash before the rollover
+        self.write_index()
+
+    def segment_filename(self, segment_num):
+        if self.rotating:
+            return f"{self.run_name}_{segment_num:04d}.hdf5"
+        return f"{self.run_name}.hdf5"
+
+    def open_segment(self, segment_num):
+        """
+        Creates the segment file with DSO group and empty channel datasets.
+        """
+        # chunk cache holds the chunks being filled, so compressed chunks are not rewritten on every record
+        f = h5py.File(self.working_dir / self.segment_filename(segment_num), "w", rdcc_nbytes=4 * CHUNK_BYTES,
+                      libver="latest" if self.swmr else None)
+        f.attrs["created"] = datetime.now().isoformat()
+        f.attrs["timestamp"] = time.time_ns()
+        f.attrs["storage_mode"] = self.storage_mode
+        f.attrs["compression"] = self.compression
+        f.attrs["run"] = self.run_name
+        f.attrs["segment"] = segment_num
+        dso = f.create_group("DSO")
+        if self.dso_information:
+            dso.attrs.update(self.dso_information)
+        channels = dict()
+        datasets = dict()
+        tables = dict()
         for ch in range(1, self.channels_num + 1):
-            self.channels[ch] = self.f.create_group(f"CH{ch:d}")
-            self.channels[ch].attrs["sampling_rate"] = self.sampling_rate
-            self.channels[ch].attrs["time_scale"] = self.time_scale
-            self.channels[ch].attrs["time_resolution"] = self.time_resolution
-        self.f.flush()
+            channels[ch] = f.create_group(f"CH{ch:d}")
+            channels[ch].attrs["sampling_rate"] = self.sampling_rate
+            channels[ch].attrs["time_scale"] = self.time_scale
+            channels[ch].attrs["time_resolution"] = self.time_resolution
+            channels[ch].attrs.update(self.channel_attrs[ch])
+            datasets[ch] = self.create_channel_datasets(channels[ch])
+            for name, fields in self.tables.items():
+                tables[(ch, name)] = self.create_table_datasets(channels[ch], name, fields)
+        f.flush()
+        return {"segment": segment_num, "f": f, "dso": dso, "channels": channels, "datasets": datasets,
+                "tables": tables}
+
+    def activate_segment(self, segment):
+        """
+        Switches writing to the opened segment and adds it to the run index.
+        """
+        self.f = segment["f"]
+        self.dso = segment["dso"]
+        self.channels = segment["channels"]
+        self.datasets = segment["datasets"]
+        self.table_datasets = segment["tables"]
+        self.f.attrs["timestamp"] = time.time_ns()
+        self.segment_start = time.monotonic()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        self.segments.append({
+            "file": Path(self.f.filename).name,
+            "segment": segment["segment"],
+            "created": datetime.now().isoformat(),
+            "timestamp_start": None,
+            "timestamp_stop": None,
+            "records": 0,
+            "rows": 0,
+        })
+
+    def rotation_due(self):
+        segment = self.segments[-1]
+        # table rows are counted in segments without records, e.g. accumulating without keeping the records
+        written = segment["records"] or segment["rows"]
+        if written == 0:
+            return False
+        if 0 < self.rotate_records <= written:
+            return True
+        if 0 < self.rotate_interval <= time.monotonic() - self.segment_start:
+            return True
+        return 0 < self.rotate_size <= self.f.id.get_filesize()
+
+    def rotate(self):
+        """
+        Switches to the pre-opened next segment and hands the finished one to the rollover thread,
+        which closes it, updates the run index and opens the following segment in advance.
+        Waits only if the previous rollover is still running.
+        """
+        rotate_start = time.time_ns()
+        self.segment_ready.wait()
+        if self.next_segment is None:
+            raise RuntimeError("Opening the next segment failed") from self.rollover_error
+        finished = self.f
+        self.activate_segment(self.next_segment)
+        self.next_segment = None
+        self.segment_ready.clear()
+        self.finished.put(finished)
+        if self.metrics is not None:
+            self.metrics.observe_ns("hdf5_rotate", time.time_ns() - rotate_start)
+            self.metrics.inc("file_rotations")
+
+    def _rollover(self):
+        while True:
+            finished = self.finished.get()
+            if finished is None:
+                return
+            try:
+                finished.close()
+                self.write_index()
+                self.next_segment = self.open_segment(self.segments[-1]["segment"] + 1)
+            except Exception as e:
+                self.rollover_error = e
+            finally:
+                self.segment_ready.set()
+
+    def write_index(self):
+        """
+        Writes the run index listing the segment files with their time range and record count.
+        """
+        if not self.rotating:
+            return
+        index = {
+            "run": self.run_name,
+            "storage_mode": self.storage_mode,
+            "channels": list(range(1, self.channels_num + 1)),
+            "segments": self.segments,
+        }
+        # write to temporary file and rename so readers never see a partial index
+        tmp_file = self.index_file.with_name(self.index_file.name + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    def create_channel_datasets(self, group):
+        """
+        Creates empty resizable waveforms dataset (records x points) and per-record index datasets.
+        """
+        if self.raw:
+            dtype, fillvalue, index_fields = np.uint8, ADC_ZERO, {**INDEX_FIELDS, **RAW_INDEX_FIELDS}
+        else:
+            dtype, fillvalue, index_fields = self.volts_dtype, np.nan, INDEX_FIELDS
+        width = self.record_length if self.record_length else 0
+        datasets = {
+            "data": group.create_dataset("data", shape=(0, width), maxshape=(None, None), dtype=dtype,
+                                         chunks=data_chunks(width, dtype, self.compression), fillvalue=fillvalue,
+                                         **self.compression_filter)
+        }
+        if self.raw:
+            datasets["data"].attrs["y_zero"] = ADC_ZERO
+        for name, field_dtype in index_fields.items():
+            datasets[name] = group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=field_dtype,
+                                                  chunks=(4096,))
+        return datasets
+
+    @staticmethod
+    def create_table_datasets(group, name, fields):
+        table = group.create_group(name)
+        datasets = dict()
+        for field, field_dtype in fields.items():
+            field_dtype = np.dtype(field_dtype)
+            # subarray dtypes make columns of arrays, one array per row
+            chunks = (4096,) if not field_dtype.shape else (1,) + field_dtype.shape
+            datasets[field] = table.create_dataset(field, shape=(0,) + field_dtype.shape,
+                                                   maxshape=(None,) + field_dtype.shape, dtype=field_dtype.base,
+                                                   chunks=chunks)
+        return datasets
+
+    def add_channel_table(self, name, fields):
+        """
+        Adds a columnar table to every channel group, `CHn/<name>` holds one resizable dataset per field.
+        Fields map the column names to dtypes, subarray dtypes like `(np.uint32, (256, 600))` make columns
+        of arrays. Tables are created in all segment files,
+        so they must be added before the first record.
+        """
+        if self.f.swmr_mode:
+            raise RuntimeError("Tables can not be added after the first record in SWMR mode")
+        self.tables[name] = dict(fields)
+        for segment in self.open_segments():
+            for ch, group in segment["channels"].items():
+                segment["tables"][(ch, name)] = self.create_table_datasets(group, name, self.tables[name])
+
+    def save_channel_table(self, ch, name, rows):
+        """
+        Appends rows to the channel table, rows map the column names to scalars or to equal length arrays.
+        Rows are flushed together with the records.
+        """
+        self.begin_write("rows", rows.get("timestamp_start"), rows.get("timestamp_stop"))
+        for field, dataset in self.table_datasets[(ch, name)].items():
+            values = np.asarray(rows[field])
+            if values.ndim < dataset.ndim:
+                values = values[np.newaxis]
+            n = dataset.shape[0]
+            dataset.resize((n + values.shape[0],) + dataset.shape[1:])
+            dataset[n:] = values
 
     def close_file(self):
+        if self.rollover_thread is not None:
+            self.finished.put(None)
+            self.rollover_thread.join()
+            self.rollover_thread = None
         if self.f:
             self.f.close()
+        if self.next_segment:
+            # the pre-opened segment was never written to
+            unused = Path(self.next_segment["f"].filename)
+            self.next_segment["f"].close()
+            unused.unlink()
+            self.next_segment = None
+        self.write_index()
+
+    def flush(self):
+        flush_start = time.time_ns()
+        self.f.flush()
+        if self.metrics is not None:
+            self.metrics.observe_ns("hdf5_flush", time.time_ns() - flush_start)
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    def flush_if_due(self):
+        """
+        Flushes the file according to the flush policy.
+        """
+        self.unflushed += 1
+        if self.flush_mode == "records":
+            if self.unflushed >= self.flush_records:
+                self.flush()
+        elif self.flush_mode == "interval":
+            if time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def open_segments(self):
+        segments = [{"f": self.f, "dso": self.dso, "channels": self.channels, "tables": self.table_datasets}]
+        if self.next_segment:
+            segments.append(self.next_segment)
+        return segments
 
     def save_dso_information(self, dso_information):
-        if self.dso:
-            self.dso.attrs["brand"] = dso_information["brand"]
-            self.dso.attrs["model"] = dso_information["model"]
-            self.dso.attrs["sn"] = dso_information["sn"]
-            self.dso.attrs["firmware"] = dso_information["firmware"]
-        if self.f:
-            self.f.flush()
+        self.dso_information = {key: dso_information[key] for key in ("brand", "model", "sn", "firmware")}
+        for segment in self.open_segments():
+            segment["dso"].attrs.update(self.dso_information)
+            segment["f"].flush()
+
+    def set_channel_attr(self, ch, name, value):
+        self.channel_attrs[ch][name] = value
+        for segment in self.open_segments():
+            segment["channels"][ch].attrs[name] = value
 
     def set_channel_label(self, ch=1, label="CH1"):
-        self.channels[ch].attrs["label"] = label
+        self.set_channel_attr(ch, "label", label)
 
     def set_channel_v_scale(self, ch=1, v_scale=1.0):
-        self.channels[ch].attrs["v_scale"] = v_scale
+        self.set_channel_attr(ch, "v_scale", v_scale)
+
+    def records_num(self, ch=1):
+        return self.datasets[ch]["data"].shape[0]
+
+    def begin_write(self, kind, timestamp_start, timestamp_stop):
+        """
+        Prepares the write of records or of table rows (kind "records" or "rows") with the time range:
+        rotates the file if due, counts the writes in the segment, extends the segment time range
+        and starts SWMR. The timestamps are scalars or arrays of the rows timestamps.
+        Writes sharing timestamp_start, like the channels of one trigger and the gate row of the record,
+        never get split between segments and each kind is counted once for them.
+        """
+        if timestamp_start is not None:
+            timestamp_start, timestamp_stop = np.atleast_1d(timestamp_start), np.atleast_1d(timestamp_stop)
+            first = int(timestamp_start[0])
+            if first != self.last_timestamp:
+                if self.rotating and self.rotation_due():
+                    self.rotate()
+                self.last_timestamp = first
+            if first != self.last_timestamps[kind]:
+                self.last_timestamps[kind] = first
+                segment = self.segments[-1]
+                segment[kind] += len(timestamp_start)
+                start, stop = int(timestamp_start.min()), int(timestamp_stop.max())
+                if segment["timestamp_start"] is None or start < segment["timestamp_start"]:
+                    segment["timestamp_start"] = start
+                if segment["timestamp_stop"] is None or stop > segment["timestamp_stop"]:
+                    segment["timestamp_stop"] = stop
+        if self.swmr and not self.f.swmr_mode:
+            # no attributes or objects may be created after SWMR is on, so it is started with the first write
+            # of each segment, after the rollover
+            self.f.swmr_mode = True
 
     def save_channel_data(self, channel_data):
-        ch = self.channels[channel_data["ch"]]
-        dataset = ch.create_dataset(str(channel_data["timestamp_start"]), data=channel_data["data"])
-        dataset.attrs["timestamp_start"] = channel_data["timestamp_start"]
-        dataset.attrs["timestamp_stop"] = channel_data["timestamp_stop"]
-        dataset.attrs["time_resolution"] = channel_data["time_resolution"]
-        dataset.attrs["sampling_rate"] = channel_data["sampling_rate"]
-        self.f.flush()
+        """
+        Appends the record to the channel waveforms dataset.
+        Records shorter than the dataset width are padded with the fill value,
+        the number of valid points is stored in the `points` index dataset.
+        """
+        write_start = time.time_ns()
+        self.begin_write("records", channel_data["timestamp_start"], channel_data["timestamp_stop"])
+        datasets = self.datasets[channel_data["ch"]]
+        data = channel_data["data"]
+        points = data.shape[0]
+        dataset = datasets["data"]
+        n, width = dataset.shape
+        dataset.resize((n + 1, max(width, points)))
+        dataset[n, :points] = data
+        for name, index_dataset in datasets.items():
+            if name == "data":
+                continue
+            index_dataset.resize((n + 1,))
+            index_dataset[n] = points if name == "points" else channel_data[name]
+        if self.metrics is not None:
+            self.metrics.observe_ns("hdf5_write", time.time_ns() - write_start)
+            self.metrics.inc("records_written")
+        self.flush_if_due()
@@ -0,0 +1,354 @@
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+
+# Journal segment file header: magic, version, frame size, max points per frame, frames num, segment, sample dtype
+FILE_MAGIC = b"DSOJRNL\x01"
+FILE_HEADER = struct.Struct("<8sIIIII4sq")
+FILE_HEADER_SIZE = 64
+# Frame header: magic, CRC32, sequence number, timestamp_start, timestamp_stop, ch, flags, points,
+# time_resolution, sampling_rate, y_increment, y_origin, y_zero. CRC32 covers the header after the CRC field
+# and the samples, magic and CRC are written last, so a torn frame never passes the check.
+FRAME_MAGIC = 0x46534F44
+FRAME_HEADER = struct.Struct("<IIQqqHHIddddd")
+FRAME_ALIGN = 64
+# Frame flags
+FLAG_RAW = 1
+
+
+def frame_size(max_points, dtype):
+    size = FRAME_HEADER.size + max_points * np.dtype(dtype).itemsize
+    return (size + FRAME_ALIGN - 1) // FRAME_ALIGN * FRAME_ALIGN
+
+
+def read_header(mm):
+    magic, version, size, max_points, frames, segment, dtype, created = FILE_HEADER.unpack_from(mm, 0)
+    if magic != FILE_MAGIC:
+        raise ValueError("Not a DSO journal file")
+    return {
+        "version": version,
+        "frame_size": size,
+        "max_points": max_points,
+        "frames": frames,
+        "segment": segment,
+        "dtype": np.dtype(dtype.rstrip(b"\x00").decode()),
+        "created": created,
+    }
+
+
+def scan_journal(filename):
+    """
+    Returns the header and the valid frames of the journal segment sorted by sequence number.
+    Frames are (seq, channel_data) tuples. Slots never written and frames failing the CRC check are counted.
+    """
+    stats = {"valid": 0, "corrupt": 0, "empty": 0}
+    frames = []
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size < FILE_HEADER_SIZE:
+            raise ValueError(f"{filename} is too short for a DSO journal file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = read_header(mm)
+            # a crash during preallocation may leave the file shorter than the header says
+            slots = min(header["frames"], (len(mm) - FILE_HEADER_SIZE) // header["frame_size"])
+            stats["empty"] += header["frames"] - slots
+            for slot in range(slots):
+                offset = FILE_HEADER_SIZE + slot * header["frame_size"]
+                fields = FRAME_HEADER.unpack_from(mm, offset)
+                magic, crc, seq, timestamp_start, timestamp_stop, ch, flags, points = fields[:8]
+                if magic == 0 and crc == 0:
+                    stats["empty"] += 1
+                    continue
+                nbytes = points * header["dtype"].itemsize
+                if (magic != FRAME_MAGIC or points > header["max_points"]
+                        or zlib.crc32(mm[offset + 8:offset + FRAME_HEADER.size + nbytes]) != crc):
+                    stats["corrupt"] += 1
+                    continue
+                time_resolution, sampling_rate, y_increment, y_origin, y_zero = fields[8:]
+                channel_data = {
+                    "timestamp_start": timestamp_start,
+                    "timestamp_stop": timestamp_stop,
+                    "ch": ch,
+                    "time_resolution": time_resolution,
+                    "sampling_rate": sampling_rate,
+                    "data": np.frombuffer(mm, dtype=header["dtype"], count=points,
+                                          offset=offset + FRAME_HEADER.size).copy(),
+                }
+                if flags & FLAG_RAW:
+                    channel_data["y_increment"] = y_increment
+                    channel_data["y_origin"] = y_origin
+                    channel_data["y_zero"] = y_zero
+                frames.append((seq, channel_data))
+                stats["valid"] += 1
+    frames.sort(key=lambda frame: frame[0])
+    return header, frames, stats
+
+
+def convert_journal(filename, streamer):
+    """
+    Appends the valid frames of the journal segment to the Streamer, returns the scan stats.
+    """
+    _, frames, stats = scan_journal(filename)
+    for _, channel_data in frames:
+        streamer.save_channel_data(channel_data)
+    return stats
+
+
+class JournalSegment:
+    """
+    Preallocated memory-mapped journal segment file with fixed size frame slots.
+    """
+
+    def __init__(self, filename, segment, max_points, dtype, size):
+        self.filename = Path(filename)
+        self.segment = segment
+        self.dtype = np.dtype(dtype)
+        self.frame_size = frame_size(max_points, self.dtype)
+        self.max_points = max_points
+        self.frames = max(1, (size - FILE_HEADER_SIZE) // self.frame_size)
+        self.used = 0
+        file_size = FILE_HEADER_SIZE + self.frames * self.frame_size
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        if hasattr(os, "posix_fallocate"):
+            # real allocation, so a full disk fails here and not with SIGBUS in the acquisition loop
+            os.posix_fallocate(self.fd, 0, file_size)
+        else:
+            os.ftruncate(self.fd, file_size)
+        self.mm = mmap.mmap(self.fd, file_size)
+        FILE_HEADER.pack_into(self.mm, 0, FILE_MAGIC, 1, self.frame_size, max_points, self.frames, segment,
+                              self.dtype.str.encode(), time.time_ns())
+        self.buffer = np.frombuffer(self.mm, dtype=np.uint8)
+
+    @property
+    def full(self):
+        return self.used >= self.frames
+
+    def append(self, seq, channel_data):
+        data = np.ascontiguousarray(channel_data["data"], dtype=self.dtype)
+        points = data.shape[0]
+        if points > self.max_points:
+            raise ValueError(f"Record of {points} points does not fit journal frame of {self.max_points} points")
+        offset = FILE_HEADER_SIZE + self.used * self.frame_size
+        samples = offset + FRAME_HEADER.size
+        self.buffer[samples:samples + data.nbytes] = data.view(np.uint8)
+        raw = "y_increment" in channel_data
+        FRAME_HEADER.pack_into(self.mm, offset, 0, 0, seq, channel_data["timestamp_start"],
+                               channel_data["timestamp_stop"], channel_data["ch"], FLAG_RAW if raw else 0, points,
+                               channel_data["time_resolution"], channel_data["sampling_rate"],
+                               channel_data["y_increment"] if raw else 0.0, channel_data["y_origin"] if raw else 0.0,
+                               channel_data["y_zero"] if raw else 0.0)
+        crc = zlib.crc32(self.buffer[offset + 8:samples + data.nbytes])
+        struct.pack_into("<II", self.mm, offset, FRAME_MAGIC, crc)
+        self.used += 1
+
+    def sync(self):
+        self.mm.flush()
+
+    def close(self):
+        del self.buffer
+        self.mm.flush()
+        self.mm.close()
+        os.close(self.fd)
+
+
+class JournalWriter:
+    """
+    Appends records as fixed size frames to preallocated memory-mapped journal segment files
+    `<run>_NNNN.journal` and folds the finished segments into the Streamer files on a background thread.
+    Has the same save_channel_data / close_file interface as the Streamer,
+    the acquisition loop only pays for copying the samples into the mapped file.
+
+    Frames stay valid after a crash of the process, with sync_records the mapping is synced to disk
+    every N records, so they survive a power loss too. The valid frames of the journal segments left
+    after a crash are converted to HDF5 with dso_recover.py.
+    Converted segments are deleted unless keep_journal is set.
+    The finished segment is synced and closed and the next one is preallocated on a rollover thread,
+    apart from the slow conversion, so the rollover in the acquisition loop only swaps the mappings.
+    """
+
+    def __init__(self, streamer, journal_size=64_000_000, sync_records=0, keep_journal=False):
+        self.streamer = streamer
+        self.journal_size = int(journal_size)
+        self.sync_records = int(sync_records)
+        self.keep_journal = keep_journal
+        self.dtype = np.uint8 if streamer.raw else streamer.volts_dtype
+        self.max_points = streamer.record_length if streamer.record_length else 1 << 20
+        self.seq = 0
+        self.unsynced = 0
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.converted_segments = 0
+        self.corrupt = 0
+        self.error = None
+        self.segments = []
+        self.segment = self.open_segment(0)
+        # preallocated segments for the rollover, None if the preallocation failed
+        self.prepared = queue.Queue()
+        self.prepared.put(self.open_segment(1))
+        # finished segments to close, then to convert
+        self.finished = queue.Queue()
+        self.queue = queue.Queue()
+        self.rollover_thread = threading.Thread(target=self._rollover, name="JournalRollover", daemon=True)
+        self.rollover_thread.start()
+        self.thread = threading.Thread(target=self._run, name="JournalConverter", daemon=True)
+        self.thread.start()
+
+    @property
+    def pending(self):
+        return self.queued - self.written - self.dropped
+
+    @property
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "pending": self.pending,
+            "segments": len(self.segments),
+            "converted_segments": self.converted_segments,
+        }
+
+    @property
+    def run_file(self):
+        return self.streamer.working_dir / f"{self.streamer.run_name}_journal.json"
+
+    def segment_filename(self, segment_num):
+        return self.streamer.working_dir / f"{self.streamer.run_name}_{segment_num:04d}.journal"
+
+    def open_segment(self, segment_num):
+        segment = JournalSegment(self.segment_filename(segment_num), segment_num, self.max_points, self.dtype,
+                                 self.journal_size)
+        self.segments.append(segment.filename.name)
+        self.write_run_file()
+        return segment
+
+    def write_run_file(self):
+        """
+        Writes the Streamer settings and the metadata the recovery tool needs to rebuild the HDF5 files.
+        """
+        streamer = self.streamer
+        run = {
+            "run": streamer.run_name,
+            "storage_mode": streamer.storage_mode,
+            "volts_dtype": streamer.volts_dtype.name,
+            "channels_num": streamer.channels_num,
+            "sampling_rate": streamer.sampling_rate,
+            "time_scale": streamer.time_scale,
+            "time_resolution": streamer.time_resolution,
+            "record_length": streamer.record_length,
+            "dso_information": streamer.dso_information,
+            "channel_attrs": {str(ch): attrs for ch, attrs in streamer.channel_attrs.items()},
+            "segments": self.segments,
+        }
+        # write to temporary file and rename so the recovery tool never sees a partial file
+        tmp_file = self.run_file.with_name(self.run_file.name + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(run, f, indent=2, default=float)
+        os.replace(tmp_file, self.run_file)
+
+    def save_channel_data(self, channel_data):
+        if self.error is not None:
+            raise RuntimeError("Journal converter failed") from self.error
+        if self.segment.full:
+            self.rotate()
+        self.segment.append(self.seq, channel_data)
+        self.seq += 1
+        self.queued += 1
+        if self.sync_records > 0:
+            self.unsynced += 1
+            if self.unsynced >= self.sync_records:
+                self.segment.sync()
+                self.unsynced = 0
+
+    def rotate(self):
+        """
+        Switches to the preallocated next segment and hands the finished one to the rollover thread,
+        which preallocates the segment for the following rollover and closes the finished one.
+        Waits only if the previous preallocation is still running.
+        """
+        finished = self.segment
+        segment = self.prepared.get()
+        if segment is None:
+            raise RuntimeError("Journal segment preallocation failed") from self.error
+        self.segment = segment
+        self.finished.put((finished, segment.segment + 1))
+
+    def prepare(self, segment_num):
+        try:
+            self.prepared.put(self.open_segment(segment_num))
+        except Exception:
+            # the next rollover fails instead of waiting forever
+            self.prepared.put(None)
+            raise
+
+    def _rollover(self):
+        while True:
+            item = self.finished.get()
+            if item is None:
+                self.queue.put(None)
+                return
+            finished, next_segment_num = item
+            try:
+                # preallocation of the next segment and msync of the finished one stay off the acquisition thread
+                if next_segment_num is not None:
+                    self.prepare(next_segment_num)
+                finished.close()
+            except Exception as e:
+                self.error = e
+            self.queue.put(finished)
+
+    def _run(self):
+        while True:
+            finished = self.queue.get()
+            try:
+                if finished is None:
+                    return
+                if self.error is None:
+                    stats = convert_journal(finished.filename, self.streamer)
+                    self.written += stats["valid"]
+                    self.corrupt += stats["corrupt"]
+                    # frames lost in the journal are not coming back
+                    self.dropped += finished.used - stats["valid"]
+                    self.converted_segments += 1
+                    if not self.keep_journal:
+                        finished.filename.unlink()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def close_file(self):
+        """
+        Converts the remaining journal segments, stops the rollover and converter threads
+        and closes the Streamer file.
+        """
+        if self.rollover_thread.is_alive():
+            self.finished.put((self.segment, None))
+            self.finished.put(None)
+            self.rollover_thread.join()
+            self.thread.join()
+        else:
+            self.segment.close()
+        try:
+            unused = self.prepared.get_nowait()
+        except queue.Empty:
+            unused = None
+        if unused is not None:
+            # the preallocated segment was never written to
+            unused.close()
+            unused.filename.unlink()
+            self.segments.remove(unused.filename.name)
+        self.streamer.close_file()
+        if self.error is None and not self.keep_journal:
+            self.run_file.unlink()
+        else:
+            self.write_run_file()
@@ -0,0 +1,256 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import h5py
+
+from dso.basic_dso import ADC_ZERO
+
+
+# Sorted per-channel record index, row is the row of the data dataset or the position in legacy names list
+INDEX_DTYPE = np.dtype([("timestamp_start", np.int64), ("timestamp_stop", np.int64), ("file", np.int32),
+                        ("row", np.int64)])
+# Records per batch for legacy files with one dataset per record
+LEGACY_BATCH_RECORDS = 256
+
+
+class Reader:
+    """
+    Read-only access to recorded runs.
+
+    Opens a single data file, a rotated run given by its index file or a list of data files.
+    Records of each channel are indexed by timestamp_start, so time range queries do not touch the waveforms,
+    and the waveforms are read lazily in batches of dataset chunk size, in volts or as raw ADC codes.
+    Legacy files with one dataset per record are indexed by parsing the dataset names,
+    the index is cached next to the file as `<file>.index.npz`.
+    """
+
+    def __init__(self, path, swmr=False):
+        if isinstance(path, (list, tuple)):
+            self.filenames = [Path(filename) for filename in path]
+        else:
+            path = Path(path)
+            if path.suffix == ".json":
+                with open(path, "r") as f:
+                    run_index = json.load(f)
+                self.filenames = [path.parent / segment["file"] for segment in run_index["segments"]]
+            else:
+                self.filenames = [path]
+        self.swmr = swmr
+        self.files = dict()
+        self.legacy_names = dict()
+        self.index = self.build_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = dict()
+
+    def file(self, file_num):
+        if file_num not in self.files:
+            if self.swmr:
+                self.files[file_num] = h5py.File(self.filenames[file_num], "r", libver="latest", swmr=True)
+            else:
+                self.files[file_num] = h5py.File(self.filenames[file_num], "r")
+        return self.files[file_num]
+
+    @property
+    def channels(self):
+        return sorted(self.index)
+
+    def records_num(self, ch=1):
+        return self.index[ch].shape[0]
+
+    def timestamps(self, ch=1):
+        return self.index[ch]["timestamp_start"]
+
+    def build_index(self):
+        """
+        Collects the records of all files and sorts them by timestamp_start for each channel.
+        """
+        parts = dict()
+        for file_num in range(len(self.filenames)):
+            f = self.file(file_num)
+            for name, group in f.items():
+                if not name.startswith("CH"):
+                    continue
+                ch = int(name[2:])
+                if "data" in group and "timestamp_start" in group:
+                    records = self.file_index(group, file_num)
+                else:
+                    records = self.legacy_index(group, file_num, ch)
+                parts.setdefault(ch, []).append(records)
+        index = dict()
+        for ch, records in parts.items():
+            records = np.concatenate(records)
+            index[ch] = records[np.argsort(records["timestamp_start"], kind="stable")]
+        return index
+
+    @staticmethod
+    def file_index(group, file_num):
+        # index datasets are appended after the waveform, a record is complete only when all are written
+        n = min(group["data"].shape[0], group["timestamp_start"].shape[0], group["timestamp_stop"].shape[0])
+        records = np.empty(n, dtype=INDEX_DTYPE)
+        records["timestamp_start"] = group["timestamp_start"][:n]
+        records["timestamp_stop"] = group["timestamp_stop"][:n]
+        records["file"] = file_num
+        records["row"] = np.arange(n)
+        return records
+
+    def legacy_index(self, group, file_num, ch):
+        """
+        Indexes legacy channel group with one dataset named by timestamp_start per record.
+        """
+        filename = self.filenames[file_num]
+        cache_file = filename.with_name(filename.name + ".index.npz")
+        key = f"CH{ch:d}"
+        if cache_file.is_file() and cache_file.stat().st_mtime >= filename.stat().st_mtime:
+            with np.load(cache_file) as cache:
+                if f"{key}_names" in cache:
+                    names = cache[f"{key}_names"]
+                    timestamp_stop = cache[f"{key}_timestamp_stop"]
+                    self.legacy_names[(file_num, ch)] = names
+                    return self.legacy_records(names, timestamp_stop, file_num)
+        names = np.array(sorted(group.keys(), key=int))
+        timestamp_stop = np.array([group[name].attrs["timestamp_stop"] for name in names], dtype=np.int64)
+        cached = dict()
+        if cache_file.is_file():
+            with np.load(cache_file) as cache:
+                cached = dict(cache)
+        cached[f"{key}_names"] = names
+        cached[f"{key}_timestamp_stop"] = timestamp_stop
+        try:
+            np.savez(cache_file, **cached)
+        except PermissionError:
+            pass
+        self.legacy_names[(file_num, ch)] = names
+        return self.legacy_records(names, timestamp_stop, file_num)
+
+    @staticmethod
+    def legacy_records(names, timestamp_stop, file_num):
+        records = np.empty(len(names), dtype=INDEX_DTYPE)
+        records["timestamp_start"] = names.astype(np.int64)
+        records["timestamp_stop"] = timestamp_stop
+        records["file"] = file_num
+        records["row"] = np.arange(len(names))
+        return records
+
+    def select(self, ch=1, start=None, stop=None):
+        """
+        Returns the index records of the channel with start <= timestamp_start < stop (nanoseconds).
+        """
+        timestamps = self.timestamps(ch)
+        i0 = 0 if start is None else np.searchsorted(timestamps, start, side="left")
+        i1 = len(timestamps) if stop is None else np.searchsorted(timestamps, stop, side="left")
+        return self.index[ch][i0:i1]
+
+    def iter_records(self, ch=1, start=None, stop=None, volts=True, batch_records=None):
+        """
+        Yields (timestamp_start, waveforms) batches of the records in the time range.
+        Waveforms are 2D arrays (records x points) in volts or as raw ADC codes,
+        shorter records are padded with nan in volts or with ADC zero code in raw.
+        Each batch holds consecutive rows of one file up to the dataset chunk size or batch_records.
+        """
+        records = self.select(ch, start, stop)
+        if records.shape[0] == 0:
+            return
+        # runs of consecutive rows of one file
+        breaks = np.flatnonzero((np.diff(records["file"]) != 0) | (np.diff(records["row"]) != 1)) + 1
+        for run in np.split(records, breaks):
+            file_num = int(run["file"][0])
+            group = self.file(file_num)[f"CH{ch:d}"]
+            legacy = (file_num, ch) in self.legacy_names
+            if batch_records:
+                batch_size = batch_records
+            elif legacy:
+                batch_size = LEGACY_BATCH_RECORDS
+            else:
+                batch_size = group["data"].chunks[0]
+            for i in range(0, run.shape[0], batch_size):
+                batch = run[i:i + batch_size]
+                if legacy:
+                    data = self.read_legacy(group, self.legacy_names[(file_num, ch)][batch["row"]], volts)
+                else:
+                    data = self.read_rows(group, batch["row"][0], batch["row"][-1] + 1, volts)
+                yield batch["timestamp_start"], data
+
+    @staticmethod
+    def read_rows(group, row_start, row_stop, volts):
+        data = group["data"][row_start:row_stop]
+        if not volts or "y_increment" not in group:
+            return data
+        y_zero = float(group["data"].attrs["y_zero"])
+        y_increment = group["y_increment"][row_start:row_stop][:, np.newaxis]
+        y_origin = group["y_origin"][row_start:row_stop][:, np.newaxis]
+        points = group["points"][row_start:row_stop][:, np.newaxis]
+        volts = (y_zero - data) * y_increment - y_origin
+        # padding codes are not waveform samples
+        volts[np.arange(data.shape[1]) >= points] = np.nan
+        return volts
+
+    @staticmethod
+    def read_legacy(group, names, volts):
+        datasets = [group[name] for name in names]
+        width = max(dataset.shape[0] for dataset in datasets)
+        raw = datasets[0].dtype == np.uint8 and "y_increment" in datasets[0].attrs
+        if raw and not volts:
+            data = np.full((len(datasets), width), ADC_ZERO, dtype=np.uint8)
+        else:
+            data = np.full((len(datasets), width), np.nan)
+        for n, dataset in enumerate(datasets):
+            waveform = dataset[()]
+            if raw and volts:
+                waveform = ((float(dataset.attrs["y_zero"]) - waveform) * float(dataset.attrs["y_increment"])
+                            - float(dataset.attrs["y_origin"]))
+            data[n, :waveform.shape[0]] = waveform
+        return data
+
+    def table(self, ch=1, name="features", start=None, stop=None):
+        """
+        Returns the columns of the channel table of all files as a dict of arrays sorted by timestamp_start,
+        with start <= timestamp_start < stop (nanoseconds). Waveforms are not read.
+        """
+        parts = dict()
+        for file_num in range(len(self.filenames)):
+            group = self.file(file_num).get(f"CH{ch:d}/{name}")
+            if group is None:
+                continue
+            # columns are appended one by one, a row is complete only when all are written
+            n = min(dataset.shape[0] for dataset in group.values())
+            for field, dataset in group.items():
+                parts.setdefault(field, []).append(dataset[:n])
+        if not parts:
+            raise KeyError(f"No table {name} in CH{ch:d}")
+        columns = {field: np.concatenate(values) for field, values in parts.items()}
+        timestamps = columns["timestamp_start"]
+        order = np.argsort(timestamps, kind="stable")
+        mask = np.ones(timestamps.shape[0], dtype=bool)
+        if start is not None:
+            mask &= timestamps >= start
+        if stop is not None:
+            mask &= timestamps < stop
+        order = order[mask[order]]
+        return {field: values[order] for field, values in columns.items()}
+
+    def read(self, ch=1, start=None, stop=None, volts=True):
+        """
+        Returns timestamp_start and waveforms of all records in the time range as single arrays.
+        """
+        batches = list(self.iter_records(ch, start, stop, volts))
+        if not batches:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0))
+        width = max(data.shape[1] for _, data in batches)
+        timestamps = np.concatenate([timestamps for timestamps, _ in batches])
+        fill_value = np.nan if batches[0][1].dtype.kind == "f" else ADC_ZERO
+        data = np.full((timestamps.shape[0], width), fill_value, dtype=batches[0][1].dtype)
+        n = 0
+        for _, batch in batches:
+            data[n:n + batch.shape[0], :batch.shape[1]] = batch
+            n += batch.shape[0]
+        return timestamps, data
@@ -0,0 +1,91 @@
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """
+    Saves records to the Streamer on a separate thread taking them from a bounded queue.
+    Has the same save_channel_data / close_file interface as the Streamer,
+    so the acquisition loop only pays for putting the record into the queue.
+
+    Overflow policy defines what happens when the queue is full:
+     - block: wait for the writer to free a slot,
+     - drop_oldest: discard the oldest queued record to make room for the new one,
+     - drop_newest: discard the new record.
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, streamer, queue_size=64, overflow="block"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Overflow policy must be one of {', '.join(self.OVERFLOW_POLICIES)}")
+        self.streamer = streamer
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="BackgroundWriter", daemon=True)
+        self.thread.start()
+
+    @property
+    def pending(self):
+        return self.queue.qsize()
+
+    @property
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "pending": self.pending
+        }
+
+    def save_channel_data(self, channel_data):
+        if self.error is not None:
+            raise RuntimeError("Background writer failed") from self.error
+        if self.overflow == "block":
+            self.queue.put(channel_data)
+        elif self.overflow == "drop_newest":
+            try:
+                self.queue.put_nowait(channel_data)
+            except queue.Full:
+                self.dropped += 1
+                return
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(channel_data)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        self.queued += 1
+
+    def _run(self):
+        while True:
+            channel_data = self.queue.get()
+            try:
+                if channel_data is None:
+                    return
+                if self.error is None:
+                    self.streamer.save_channel_data(channel_data)
+                    self.written += 1
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def close_file(self):
+        """
+        Saves all queued records, stops the writer thread and closes the Streamer file.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.streamer.close_file()
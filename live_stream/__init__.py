@@ -0,0 +1,300 @@
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from processing import Stage
+
+
+# Frame header: magic, version, ch, sequence number, timestamp_start, timestamp_stop, publish time (ns),
+# points, payload bytes, payload dtype ("u1" ADC codes, "f4" or "f8" volts),
+# time_resolution, sampling_rate, y_increment, y_origin, y_zero. The payload of raw samples follows the header.
+FRAME_MAGIC = b"DSOL"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sHHQqqqII2s2xddddd")
+PAYLOAD_DTYPES = {"u1": np.uint8, "f4": np.float32, "f8": np.float64}
+
+
+def parse_address(address):
+    """
+    Returns socket family and address for `unix:/path/to.sock` or `tcp:host:port`.
+    """
+    kind, _, rest = address.partition(":")
+    if kind == "unix":
+        return socket.AF_UNIX, rest
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    raise ValueError(f"Address must be unix:/path/to.sock or tcp:host:port, got {address}")
+
+
+def pack_frame(seq, channel_data, publish_time):
+    data = np.ascontiguousarray(channel_data["data"])
+    dtype = data.dtype.str[1:]
+    if dtype not in PAYLOAD_DTYPES:
+        data = data.astype(np.float64)
+        dtype = "f8"
+    raw = "y_increment" in channel_data
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, channel_data["ch"], seq, channel_data["timestamp_start"],
+                               channel_data["timestamp_stop"], publish_time, data.shape[0], data.nbytes,
+                               dtype.encode(), channel_data["time_resolution"], channel_data["sampling_rate"],
+                               channel_data["y_increment"] if raw else 0.0, channel_data["y_origin"] if raw else 0.0,
+                               channel_data["y_zero"] if raw else 0.0)
+    return header + data.tobytes()
+
+
+class Subscription:
+    """
+    Connected subscriber with the bounded buffer of frames waiting to be sent.
+    """
+
+    def __init__(self, sock, name, buffer_frames):
+        self.sock = sock
+        self.name = name
+        self.frames = deque(maxlen=buffer_frames)
+        self.current = None
+        self.sent = 0
+        self.dropped = 0
+
+
+class Publisher(Stage):
+    """
+    Publishes every record to the subscribers connected to a Unix domain or localhost TCP socket.
+
+    Frames are a fixed binary header followed by the raw samples, see FRAME_HEADER.
+    Every subscriber has a bounded buffer of buffer_frames frames, when a slow subscriber lets it fill up
+    the oldest frame is dropped and counted, so live views see the freshest records.
+    The acquisition thread only packs the frame and appends it to the buffers, the sockets are served
+    by a sender thread with non-blocking I/O, so the acquisition is never blocked by the subscribers.
+    Published records go on to the sink as well.
+    """
+
+    def __init__(self, sink, address="unix:/tmp/dso_stream.sock", buffer_frames=64):
+        super().__init__(sink)
+        self.address = address
+        self.buffer_frames = max(1, int(buffer_frames))
+        self.family, self.bind_address = parse_address(address)
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            # stale socket of the previous run
+            os.unlink(self.bind_address)
+        self.server = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.bind_address)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.subscriptions = []
+        self.seq = 0
+        self.published = 0
+        self.disconnected_dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="Publisher", daemon=True)
+        self.thread.start()
+
+    @property
+    def dropped(self):
+        return self.disconnected_dropped + sum(subscription.dropped for subscription in self.subscriptions)
+
+    @property
+    def stats(self):
+        return {
+            "published": self.published,
+            "subscribers": len(self.subscriptions),
+            "dropped": self.dropped,
+            "subscriber_dropped": {subscription.name: subscription.dropped for subscription in self.subscriptions},
+        }
+
+    def save_channel_data(self, channel_data):
+        subscriptions = self.subscriptions
+        if subscriptions:
+            frame = pack_frame(self.seq, channel_data, time.time_ns())
+            for subscription in subscriptions:
+                if len(subscription.frames) == self.buffer_frames:
+                    subscription.dropped += 1
+                subscription.frames.append(frame)
+            self.published += 1
+            try:
+                self.wakeup_send.send(b"\0")
+            except BlockingIOError:
+                # the sender is woken up already
+                pass
+        self.seq += 1
+        self.sink.save_channel_data(channel_data)
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.server, selectors.EVENT_READ, "accept")
+        selector.register(self.wakeup_recv, selectors.EVENT_READ, "wakeup")
+        writing = set()
+        while self.running:
+            for key, events in selector.select(timeout=0.5):
+                if key.data == "accept":
+                    self.accept(selector)
+                elif key.data == "wakeup":
+                    try:
+                        while self.wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif events & selectors.EVENT_READ and not self.send(key.data):
+                    # EOF or error of the subscriber
+                    self.disconnect(selector, key.data, writing)
+            for subscription in list(self.subscriptions):
+                if not self.send(subscription):
+                    self.disconnect(selector, subscription, writing)
+                    continue
+                # wait for the socket to drain only while there is something to send
+                pending = subscription.current is not None or bool(subscription.frames)
+                if pending and subscription not in writing:
+                    selector.modify(subscription.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, subscription)
+                    writing.add(subscription)
+                elif not pending and subscription in writing:
+                    selector.modify(subscription.sock, selectors.EVENT_READ, subscription)
+                    writing.discard(subscription)
+        selector.close()
+
+    def accept(self, selector):
+        try:
+            sock, address = self.server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        name = f"{address[0]}:{address[1]}" if self.family == socket.AF_INET else f"unix:{sock.fileno()}"
+        subscription = Subscription(sock, name, self.buffer_frames)
+        selector.register(sock, selectors.EVENT_READ, subscription)
+        # replaced, not appended, so the acquisition thread iterates a consistent list
+        self.subscriptions = self.subscriptions + [subscription]
+
+    @staticmethod
+    def send(subscription):
+        """
+        Sends the buffered frames until the socket would block, returns False if the subscriber is gone.
+        """
+        try:
+            if subscription.sock.recv(4096, socket.MSG_DONTWAIT) == b"":
+                return False
+        except BlockingIOError:
+            pass
+        except OSError:
+            return False
+        while True:
+            if subscription.current is None:
+                if not subscription.frames:
+                    return True
+                subscription.current = memoryview(subscription.frames.popleft())
+            try:
+                sent = subscription.sock.send(subscription.current)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            subscription.current = subscription.current[sent:]
+            if not subscription.current:
+                subscription.current = None
+                subscription.sent += 1
+
+    def disconnect(self, selector, subscription, writing):
+        selector.unregister(subscription.sock)
+        subscription.sock.close()
+        writing.discard(subscription)
+        self.disconnected_dropped += subscription.dropped
+        self.subscriptions = [other for other in self.subscriptions if other is not subscription]
+
+    def close_file(self):
+        """
+        Stops the sender thread, disconnects the subscribers and closes the sink.
+        """
+        self.running = False
+        try:
+            self.wakeup_send.send(b"\0")
+        except BlockingIOError:
+            pass
+        self.thread.join()
+        for subscription in self.subscriptions:
+            subscription.sock.close()
+        self.subscriptions = []
+        self.server.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind_address):
+            os.unlink(self.bind_address)
+        self.sink.close_file()
+
+
+class Subscriber:
+    """
+    Client of the Publisher, iterating over the received records.
+    Records are channel_data dicts with the `seq` and `publish_time` of the frame added.
+    """
+
+    def __init__(self, address="unix:/tmp/dso_stream.sock", timeout=None):
+        family, connect_address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(connect_address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            record = self.receive()
+            if record is None:
+                return
+            yield record
+
+    def read_exactly(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                return None
+            received += n
+        return buffer
+
+    def receive(self):
+        """
+        Returns the next record, None when the publisher closes the connection.
+        """
+        header = self.read_exactly(FRAME_HEADER.size)
+        if header is None:
+            return None
+        (magic, version, ch, seq, timestamp_start, timestamp_stop, publish_time, points, payload_bytes, dtype,
+         time_resolution, sampling_rate, y_increment, y_origin, y_zero) = FRAME_HEADER.unpack(header)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise ValueError("Not a DSO live stream frame")
+        payload = self.read_exactly(payload_bytes) if payload_bytes else bytearray()
+        if payload is None:
+            return None
+        dtype = PAYLOAD_DTYPES[dtype.decode()]
+        record = {
+            "seq": seq,
+            "publish_time": publish_time,
+            "timestamp_start": timestamp_start,
+            "timestamp_stop": timestamp_stop,
+            "ch": ch,
+            "time_resolution": time_resolution,
+            "sampling_rate": sampling_rate,
+            "data": np.frombuffer(payload, dtype=dtype, count=points),
+        }
+        if dtype == np.uint8:
+            record["y_increment"] = y_increment
+            record["y_origin"] = y_origin
+            record["y_zero"] = y_zero
+        return record
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,4 @@
+from .stage import Stage
+from .gate import ChangeGate
+from .features import FeatureExtractor
+from .accumulate import Accumulator
@@ -0,0 +1,169 @@
+import numpy as np
+
+from .stage import Stage
+
+
+# average: running sum of the ADC codes, persistence: ADC code x sample histogram, both: the two of them
+ACCUMULATION_MODES = ("average", "persistence", "both")
+ADC_CODES = 256
+# Per-flush columns shared by the average and persistence tables
+ACCUMULATION_FIELDS = {
+    "timestamp_start": np.int64,
+    "timestamp_stop": np.int64,
+    "count": np.int64,
+    "points": np.int64,
+    "time_resolution": np.float64,
+    "sampling_rate": np.float64,
+    "y_increment": np.float64,
+    "y_origin": np.float64,
+    "y_zero": np.float64,
+}
+
+
+class ChannelAccumulator:
+    """
+    Preallocated integer accumulators of one channel, records of the same scale and length are accumulated.
+    """
+
+    def __init__(self, width, average=True, persistence=False):
+        self.width = width
+        self.sum = np.zeros(width, dtype=np.uint64) if average else None
+        self.histogram = np.zeros((ADC_CODES, width), dtype=np.uint32) if persistence else None
+        self.columns = np.arange(width)
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def matches(self, channel_data):
+        first = self.first
+        return first is None or (channel_data["data"].shape[0] == first["points"]
+                                 and all(channel_data[key] == first[key] for key in
+                                         ("y_increment", "y_origin", "y_zero", "time_resolution", "sampling_rate")))
+
+    def add(self, channel_data):
+        codes = channel_data["data"]
+        points = codes.shape[0]
+        if points > self.width:
+            raise ValueError(f"Record of {points} points does not fit accumulator of {self.width} points")
+        if self.first is None:
+            self.first = {key: channel_data[key] for key in
+                          ("timestamp_start", "y_increment", "y_origin", "y_zero", "time_resolution", "sampling_rate")}
+            self.first["points"] = points
+        self.last = channel_data["timestamp_stop"]
+        if self.sum is not None:
+            self.sum[:points] += codes
+        if self.histogram is not None:
+            # every sample column is hit once per record, so fancy indexing adds without collisions
+            self.histogram.ravel()[codes.astype(np.intp) * self.width + self.columns[:points]] += 1
+        self.count += 1
+
+    def row(self):
+        return {
+            "timestamp_start": self.first["timestamp_start"],
+            "timestamp_stop": self.last,
+            "count": self.count,
+            "points": self.first["points"],
+            "time_resolution": self.first["time_resolution"],
+            "sampling_rate": self.first["sampling_rate"],
+            "y_increment": self.first["y_increment"],
+            "y_origin": self.first["y_origin"],
+            "y_zero": self.first["y_zero"],
+        }
+
+    def reset(self):
+        if self.sum is not None:
+            self.sum.fill(0)
+        if self.histogram is not None:
+            self.histogram.fill(0)
+        self.count = 0
+        self.first = None
+        self.last = None
+
+
+class Accumulator(Stage):
+    """
+    Accumulates raw ADC code records instead of storing each of them.
+
+    In average mode the codes are summed, in persistence mode the (256 x points) histogram of codes
+    at every sample is counted. After `records` records or `interval` seconds of record timestamps,
+    and when the scale or length of the records change, the accumulators are appended as one row
+    of the `CHn/average` table (`sum` column) and/or the `CHn/persistence` table (`histogram` column)
+    with the accumulation count, time range and scale, then they are cleared.
+    The average waveform in volts is `(y_zero - sum / count) * y_increment - y_origin`.
+    Memory use does not depend on the accumulation length.
+    The records themselves reach the sink only with keep_records.
+    """
+
+    def __init__(self, sink, mode="average", records=1000, interval=0.0, keep_records=False, metrics=None):
+        if mode not in ACCUMULATION_MODES:
+            raise ValueError(f"Accumulation mode must be one of {', '.join(ACCUMULATION_MODES)}")
+        if not sink.raw:
+            raise ValueError("Accumulation needs raw storage mode")
+        if not sink.record_length:
+            raise ValueError("Accumulation needs the record length")
+        super().__init__(sink)
+        self.average = mode in ("average", "both")
+        self.persistence = mode in ("persistence", "both")
+        self.records = int(records)
+        self.interval_ns = int(interval * 1e9)
+        self.keep_records = keep_records
+        self.metrics = metrics
+        self.width = sink.record_length
+        self.accumulators = dict()
+        self.records_num = 0
+        self.flushes = 0
+        if self.average:
+            self.sink.add_channel_table("average", {**ACCUMULATION_FIELDS, "sum": (np.uint64, (self.width,))})
+        if self.persistence:
+            self.sink.add_channel_table("persistence", {**ACCUMULATION_FIELDS,
+                                                        "histogram": (np.uint32, (ADC_CODES, self.width))})
+
+    @property
+    def stats(self):
+        return {
+            "records": self.records_num,
+            "flushes": self.flushes,
+            "accumulated": {ch: accumulator.count for ch, accumulator in self.accumulators.items()},
+        }
+
+    def save_channel_data(self, channel_data):
+        if "y_increment" not in channel_data:
+            raise ValueError("Accumulation needs raw ADC code records")
+        ch = channel_data["ch"]
+        accumulator = self.accumulators.get(ch)
+        if accumulator is None:
+            accumulator = ChannelAccumulator(self.width, average=self.average, persistence=self.persistence)
+            self.accumulators[ch] = accumulator
+        if not accumulator.matches(channel_data):
+            self.flush(ch)
+        accumulator.add(channel_data)
+        self.records_num += 1
+        if self.keep_records:
+            self.sink.save_channel_data(channel_data)
+        if 0 < self.records <= accumulator.count:
+            self.flush(ch)
+        elif 0 < self.interval_ns <= channel_data["timestamp_stop"] - accumulator.first["timestamp_start"]:
+            self.flush(ch)
+
+    def flush(self, ch):
+        """
+        Appends the accumulators of the channel to the tables and clears them.
+        """
+        accumulator = self.accumulators[ch]
+        if accumulator.count == 0:
+            return
+        row = accumulator.row()
+        if self.average:
+            self.sink.save_channel_table(ch, "average", {**row, "sum": accumulator.sum})
+        if self.persistence:
+            self.sink.save_channel_table(ch, "persistence", {**row, "histogram": accumulator.histogram})
+        self.sink.flush()
+        accumulator.reset()
+        self.flushes += 1
+        if self.metrics is not None:
+            self.metrics.inc("accumulation_flushes")
+
+    def close_file(self):
+        for ch in self.accumulators:
+            self.flush(ch)
+        self.sink.close_file()
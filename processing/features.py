@@ -0,0 +1,240 @@
+import multiprocessing
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from dso.basic_dso import codes_to_volts
+from .stage import Stage
+
+
+# Per-record pulse features table of each channel, times are in seconds from the record start
+FEATURES_TABLE = "features"
+FEATURE_FIELDS = {
+    "timestamp_start": np.int64,
+    "timestamp_stop": np.int64,
+    "baseline": np.float64,
+    "baseline_rms": np.float64,
+    "height": np.float64,
+    "peak_time": np.float64,
+    "area": np.float64,
+    "rise_time": np.float64,
+    "arrival_time": np.float64,
+}
+POLARITIES = ("positive", "negative")
+
+
+def crossing_times(signal, height, peak, before, fraction, time_resolution):
+    """
+    Returns the times of the last rise through fraction of the pulse height before the peak,
+    linearly interpolated between the samples, nan if the record starts above the level.
+    """
+    n, width = signal.shape
+    rows = np.arange(n)
+    level = fraction * height
+    below = (signal < level[:, np.newaxis]) & before
+    found = below.any(axis=1)
+    last = width - 1 - np.argmax(below[:, ::-1], axis=1)
+    i0 = np.clip(last, 0, max(width - 2, 0))
+    i1 = np.minimum(i0 + 1, width - 1)
+    s0, s1 = signal[rows, i0], signal[rows, i1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        step = np.clip((level - s0) / (s1 - s0), 0.0, 1.0)
+    return np.where(found & (peak > last), (i0 + step) * time_resolution, np.nan)
+
+
+def extract_features(volts, points, time_resolution, baseline_points=16, polarity="positive"):
+    """
+    Computes the pulse features of a batch of records (records x points) in volts with vectorized numpy.
+    Baseline and its RMS are taken from the first baseline_points samples, height is the maximal deviation
+    from the baseline in the pulse polarity, area is the integral of the deviation, rise time is between 10%
+    and 90% of the height and arrival time is at 50% of the height on the leading edge.
+    Samples beyond the points of the record are ignored. Returns dict of feature arrays.
+    """
+    n, width = volts.shape
+    valid = np.arange(width) < points[:, np.newaxis]
+    window = volts[:, :max(1, min(baseline_points, width))]
+    window_valid = valid[:, :window.shape[1]]
+    counts = np.maximum(window_valid.sum(axis=1), 1)
+    baseline = np.where(window_valid, window, 0.0).sum(axis=1) / counts
+    deviation = np.where(window_valid, window - baseline[:, np.newaxis], 0.0)
+    baseline_rms = np.sqrt((deviation * deviation).sum(axis=1) / counts)
+    signal = volts - baseline[:, np.newaxis]
+    if polarity == "negative":
+        signal = -signal
+    signal = np.where(valid, signal, 0.0)
+    peak = np.argmax(np.where(valid, signal, -np.inf), axis=1)
+    height = signal[np.arange(n), peak]
+    before = np.arange(width) <= peak[:, np.newaxis]
+    t10 = crossing_times(signal, height, peak, before, 0.1, time_resolution)
+    t50 = crossing_times(signal, height, peak, before, 0.5, time_resolution)
+    t90 = crossing_times(signal, height, peak, before, 0.9, time_resolution)
+    pulse = height > 0
+    return {
+        "baseline": baseline,
+        "baseline_rms": baseline_rms,
+        "height": height,
+        "peak_time": peak * time_resolution,
+        "area": signal.sum(axis=1) * time_resolution,
+        "rise_time": np.where(pulse, t90 - t10, np.nan),
+        "arrival_time": np.where(pulse, t50, np.nan),
+    }
+
+
+def ignore_sigint():
+    # Ctrl+C stops the acquisition, the workers finish the pending batches
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "pthread_sigmask"):
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGINT})
+
+
+class ChannelBatch:
+    """
+    Preallocated batch of the records of one channel in volts, the records are copied in on arrival,
+    so reused DSO buffers may be overwritten while the batch fills.
+    """
+
+    def __init__(self, records, width, time_resolution):
+        self.volts = np.full((records, width), np.nan)
+        self.points = np.zeros(records, dtype=np.int64)
+        self.timestamp_start = np.zeros(records, dtype=np.int64)
+        self.timestamp_stop = np.zeros(records, dtype=np.int64)
+        self.time_resolution = time_resolution
+        self.size = 0
+
+    @property
+    def full(self):
+        return self.size >= self.volts.shape[0]
+
+    def fits(self, channel_data):
+        return (channel_data["data"].shape[0] <= self.volts.shape[1]
+                and channel_data["time_resolution"] == self.time_resolution)
+
+    def append(self, channel_data):
+        data = channel_data["data"]
+        points = data.shape[0]
+        row = self.volts[self.size]
+        if "y_increment" in channel_data:
+            codes_to_volts(data, channel_data["y_increment"], channel_data["y_origin"], channel_data["y_zero"],
+                           out=row[:points])
+        else:
+            row[:points] = data
+        self.points[self.size] = points
+        self.timestamp_start[self.size] = channel_data["timestamp_start"]
+        self.timestamp_stop[self.size] = channel_data["timestamp_stop"]
+        self.size += 1
+
+
+class FeatureExtractor(Stage):
+    """
+    Computes pulse features of every record and appends them to the columnar `CHn/features` table.
+
+    Records are copied to per-channel batches of batch_records records and the features of a full batch are
+    computed at once. With workers > 0 batches of at least pool_min_points samples are computed
+    in a process pool while the next batch fills, smaller ones on the calling thread.
+    Feature rows are appended in the record order, with the pool they may lag the records by a few batches.
+    Every record is passed on to the sink.
+    """
+
+    def __init__(self, sink, batch_records=64, baseline_points=16, polarity="positive", workers=0,
+                 pool_min_points=1_000_000, metrics=None):
+        if polarity not in POLARITIES:
+            raise ValueError(f"Polarity must be one of {', '.join(POLARITIES)}")
+        super().__init__(sink)
+        self.batch_records = max(1, int(batch_records))
+        self.baseline_points = baseline_points
+        self.polarity = polarity
+        self.workers = int(workers)
+        self.pool_min_points = pool_min_points
+        self.metrics = metrics
+        self.pool = None
+        self.batches = dict()
+        # (ch, batch, features or future) in submission order
+        self.pending = deque()
+        self.records = 0
+        self.batches_num = 0
+        self.pooled = 0
+        self.sink.add_channel_table(FEATURES_TABLE, FEATURE_FIELDS)
+
+    @property
+    def stats(self):
+        return {
+            "records": self.records,
+            "batches": self.batches_num,
+            "pooled_batches": self.pooled,
+            "pending_batches": len(self.pending),
+        }
+
+    def save_channel_data(self, channel_data):
+        ch = channel_data["ch"]
+        batch = self.batches.get(ch)
+        if batch is not None and not batch.fits(channel_data):
+            self.submit(ch)
+            batch = None
+        if batch is None:
+            width = self.sink.record_length or channel_data["data"].shape[0]
+            batch = ChannelBatch(self.batch_records, max(width, channel_data["data"].shape[0]),
+                                 channel_data["time_resolution"])
+            self.batches[ch] = batch
+        batch.append(channel_data)
+        self.records += 1
+        self.sink.save_channel_data(channel_data)
+        if batch.full:
+            self.submit(ch)
+        self.write_done()
+
+    def submit(self, ch):
+        batch = self.batches.pop(ch)
+        if batch.size == 0:
+            return
+        volts, points = batch.volts[:batch.size], batch.points[:batch.size]
+        args = (volts, points, batch.time_resolution, self.baseline_points, self.polarity)
+        self.batches_num += 1
+        if self.workers > 0 and volts.size >= self.pool_min_points:
+            if self.pool is None:
+                # spawn, the writer thread may hold HDF5 locks a forked worker would inherit
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=ignore_sigint)
+            # workers are spawned on submit, they inherit SIGINT blocked until the initializer ignores it
+            mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT}) if hasattr(signal, "pthread_sigmask") \
+                else None
+            try:
+                self.pending.append((ch, batch, self.pool.submit(extract_features, *args)))
+            finally:
+                if mask is not None:
+                    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+            self.pooled += 1
+        else:
+            self.pending.append((ch, batch, extract_features(*args)))
+
+    def write_done(self, wait=False):
+        """
+        Appends the features of the computed batches to the tables, keeping the submission order.
+        """
+        while self.pending:
+            ch, batch, features = self.pending[0]
+            if not isinstance(features, dict):
+                if not wait and not features.done():
+                    return
+                features = features.result()
+            self.pending.popleft()
+            features["timestamp_start"] = batch.timestamp_start[:batch.size]
+            features["timestamp_stop"] = batch.timestamp_stop[:batch.size]
+            self.sink.save_channel_table(ch, FEATURES_TABLE, features)
+            if self.metrics is not None:
+                self.metrics.inc("feature_rows", batch.size)
+
+    def close_file(self):
+        """
+        Computes the features of the partial batches, writes all pending features and closes the sink.
+        """
+        for ch in list(self.batches):
+            self.submit(ch)
+        try:
+            self.write_done(wait=True)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+            self.sink.close_file()
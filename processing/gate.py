@@ -0,0 +1,172 @@
+import numpy as np
+
+from dso.basic_dso import codes_to_volts
+from .stage import Stage
+
+
+# Per-record gate statistics table of each channel
+GATE_TABLE = "gate"
+GATE_FIELDS = {
+    "timestamp_start": np.int64,
+    "timestamp_stop": np.int64,
+    "mean": np.float64,
+    "min": np.float64,
+    "max": np.float64,
+    "rms": np.float64,
+    "peak_deviation": np.float64,
+    "correlation": np.float64,
+    "noise": np.float64,
+    "decision": np.uint8,
+}
+# Gate decisions stored in the decision column, dropped records are kept as the statistics row only
+DECISIONS = ("dropped", "warmup", "peak", "rms", "correlation", "sampled")
+
+
+def record_volts(channel_data):
+    data = channel_data["data"]
+    if "y_increment" in channel_data:
+        return codes_to_volts(data, channel_data["y_increment"], channel_data["y_origin"], channel_data["y_zero"])
+    return np.asarray(data, dtype=np.float64)
+
+
+def template_correlation(residual, template):
+    """
+    Returns the maximal normalized correlation of the residual with the zero mean template over all lags.
+    """
+    m = template.shape[0]
+    if residual.shape[0] < m:
+        return 0.0
+    numerator = np.correlate(residual, template, mode="valid")
+    energy = np.concatenate(([0.0], np.cumsum(residual * residual)))
+    window = np.sqrt(np.maximum(energy[m:] - energy[:-m], 0.0)) * np.linalg.norm(template)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = np.where(window > 0, numerator / window, 0.0)
+    return float(correlation.max())
+
+
+class ChannelBaseline:
+    """
+    Rolling baseline of one channel: exponential moving average of the baseline waveforms and of their noise power.
+    """
+
+    def __init__(self, records=32):
+        self.records = max(1, int(records))
+        self.mean = None
+        self.noise_power = 0.0
+        self.count = 0
+
+    @property
+    def ready(self):
+        return self.count >= self.records
+
+    @property
+    def noise(self):
+        return float(np.sqrt(self.noise_power))
+
+    def residual(self, volts):
+        if self.mean is None or self.mean.shape[0] != volts.shape[0]:
+            # the record length changed, the baseline is learned again
+            self.mean = volts.copy()
+            self.noise_power = 0.0
+            self.count = 0
+        return volts - self.mean
+
+    def update(self, volts, residual):
+        self.count += 1
+        # cumulative average while learning, moving average afterwards
+        alpha = 1.0 / min(self.count, self.records)
+        self.mean += alpha * (volts - self.mean)
+        self.noise_power += alpha * (float(np.mean(residual * residual)) - self.noise_power)
+
+
+class ChangeGate(Stage):
+    """
+    Stores only the records differing from the rolling baseline of the channel.
+
+    The residual of each record against the baseline waveform is tested by three gates:
+     - peak: maximal absolute deviation above peak_sigma times the baseline noise RMS,
+     - rms: RMS of the residual above rms_factor times the baseline noise RMS,
+     - correlation: normalized correlation with the pulse template above correlation threshold.
+    Records passing none of the gates are baseline, they update the baseline and only every keep_every-th
+    of them is stored. The statistics of every record with the gate decision are appended to the
+    `CHn/gate` table, so the dropped records are kept as summary rows.
+    The first baseline_records records of the channel are stored while the baseline is learned.
+    Only the kept records reach the sink.
+    """
+
+    def __init__(self, sink, baseline_records=32, peak_sigma=6.0, rms_factor=1.5, template=None, correlation=0.8,
+                 keep_every=100, metrics=None):
+        super().__init__(sink)
+        self.baseline_records = baseline_records
+        self.peak_sigma = peak_sigma
+        self.rms_factor = rms_factor
+        if template is not None:
+            template = np.asarray(template, dtype=np.float64)
+            template = template - template.mean()
+        self.template = template
+        self.correlation = correlation
+        self.keep_every = int(keep_every)
+        self.metrics = metrics
+        self.baselines = dict()
+        self.baseline_seen = dict()
+        self.counters = {decision: 0 for decision in DECISIONS}
+        self.sink.add_channel_table(GATE_TABLE, GATE_FIELDS)
+
+    @property
+    def stats(self):
+        records = sum(self.counters.values())
+        return {
+            "records": records,
+            "kept": records - self.counters["dropped"],
+            **self.counters,
+        }
+
+    def decide(self, ch, volts):
+        """
+        Returns the gate decision and the statistics row of the record.
+        """
+        baseline = self.baselines.setdefault(ch, ChannelBaseline(self.baseline_records))
+        residual = baseline.residual(volts)
+        peak_deviation = float(np.abs(residual).max()) if residual.shape[0] else 0.0
+        rms = float(np.sqrt(np.mean(residual * residual))) if residual.shape[0] else 0.0
+        correlation = template_correlation(residual, self.template) if self.template is not None else 0.0
+        noise = baseline.noise
+        row = {
+            "mean": float(volts.mean()) if volts.shape[0] else 0.0,
+            "min": float(volts.min()) if volts.shape[0] else 0.0,
+            "max": float(volts.max()) if volts.shape[0] else 0.0,
+            "rms": rms,
+            "peak_deviation": peak_deviation,
+            "correlation": correlation,
+            "noise": noise,
+        }
+        if not baseline.ready:
+            decision = "warmup"
+        elif peak_deviation > self.peak_sigma * noise:
+            decision = "peak"
+        elif rms > self.rms_factor * noise:
+            decision = "rms"
+        elif self.template is not None and correlation > self.correlation:
+            decision = "correlation"
+        else:
+            seen = self.baseline_seen.get(ch, 0)
+            self.baseline_seen[ch] = seen + 1
+            decision = "sampled" if self.keep_every > 0 and seen % self.keep_every == 0 else "dropped"
+        if decision in ("warmup", "sampled", "dropped"):
+            baseline.update(volts, residual)
+        return decision, row
+
+    def save_channel_data(self, channel_data):
+        decision, row = self.decide(channel_data["ch"], record_volts(channel_data))
+        self.counters[decision] += 1
+        if self.metrics is not None:
+            self.metrics.inc(f"gate_{decision}")
+        row["timestamp_start"] = channel_data["timestamp_start"]
+        row["timestamp_stop"] = channel_data["timestamp_stop"]
+        row["decision"] = DECISIONS.index(decision)
+        # the row goes first, so it is flushed with the kept record, a dropped record counts for the flush policy
+        self.sink.save_channel_table(channel_data["ch"], GATE_TABLE, row)
+        if decision != "dropped":
+            self.sink.save_channel_data(channel_data)
+        else:
+            self.sink.flush_if_due()
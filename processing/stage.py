@@ -0,0 +1,21 @@
+class Stage:
+    """
+    Processing stage in front of a sink with the save_channel_data / close_file interface of the Streamer.
+    Records are passed to the sink unchanged unless the stage overrides save_channel_data.
+    Other attributes are taken from the sink, so stages can be stacked and put under the background writer.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def __getattr__(self, name):
+        if name == "sink":
+            # not set yet, e.g. while the stage is being created
+            raise AttributeError(name)
+        return getattr(self.sink, name)
+
+    def save_channel_data(self, channel_data):
+        self.sink.save_channel_data(channel_data)
+
+    def close_file(self):
+        self.sink.close_file()
@@ -0,0 +1,190 @@
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+
+# Histogram bucket upper bounds in seconds: R10 series from 1 us to 100 s
+BUCKET_MANTISSAS = (1.0, 1.25, 1.6, 2.0, 2.5, 3.15, 4.0, 5.0, 6.3, 8.0)
+BUCKETS = tuple(m * 10.0 ** e for e in range(-6, 2) for m in BUCKET_MANTISSAS) + (100.0,)
+
+
+class Counter:
+
+    def __init__(self, name, help_text=""):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+
+    def __init__(self, name, help_text=""):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    Latency histogram with fixed bucket bounds in seconds.
+    """
+
+    def __init__(self, name, help_text="", buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q):
+        """
+        Estimates the quantile by linear interpolation inside the bucket.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            if n and cumulative + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                lower = max(lower, self.min)
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - cumulative) / n
+            cumulative += n
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Registry of counters, gauges and latency histograms of the acquisition pipeline.
+    Metrics are periodically exported to JSON lines file and Prometheus text format file
+    to be picked up by the node-exporter textfile collector.
+    Metrics may be registered from any thread while an export is running, exports iterate over copies.
+    """
+
+    def __init__(self, prefix="dso_stream", jsonl_file="", prometheus_file="", export_interval=10.0):
+        self.prefix = prefix
+        self.jsonl_file = Path(jsonl_file) if jsonl_file else None
+        self.prometheus_file = Path(prometheus_file) if prometheus_file else None
+        self.export_interval = export_interval
+        self.last_export = time.monotonic()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def register(self, metrics, name, metric_class, help_text=""):
+        metric = metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = metrics.get(name)
+                if metric is None:
+                    metric = metric_class(name, help_text)
+                    metrics[name] = metric
+        return metric
+
+    def counter(self, name, help_text=""):
+        return self.register(self.counters, name, Counter, help_text)
+
+    def gauge(self, name, help_text=""):
+        return self.register(self.gauges, name, Gauge, help_text)
+
+    def histogram(self, name, help_text=""):
+        return self.register(self.histograms, name, Histogram, help_text)
+
+    def inc(self, name, n=1):
+        self.counter(name).inc(n)
+
+    def set(self, name, value):
+        self.gauge(name).set(value)
+
+    def observe_ns(self, name, duration_ns):
+        self.histogram(name).observe(duration_ns / 1e9)
+
+    def snapshot(self):
+        return {
+            "timestamp": time.time_ns(),
+            "counters": {name: counter.value for name, counter in list(self.counters.items())},
+            "gauges": {name: gauge.value for name, gauge in list(self.gauges.items())},
+            "histograms": {name: histogram.snapshot() for name, histogram in list(self.histograms.items())},
+        }
+
+    def prometheus_text(self):
+        lines = []
+        for name, counter in list(self.counters.items()):
+            metric = f"{self.prefix}_{name}_total"
+            if counter.help_text:
+                lines.append(f"# HELP {metric} {counter.help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {counter.value}")
+        for name, gauge in list(self.gauges.items()):
+            metric = f"{self.prefix}_{name}"
+            if gauge.help_text:
+                lines.append(f"# HELP {metric} {gauge.help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {gauge.value}")
+        for name, histogram in list(self.histograms.items()):
+            metric = f"{self.prefix}_{name}_seconds"
+            if histogram.help_text:
+                lines.append(f"# HELP {metric} {histogram.help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in zip(histogram.buckets, histogram.counts):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        if self.jsonl_file:
+            with open(self.jsonl_file, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+        if self.prometheus_file:
+            # write to temporary file and rename so the collector never reads a partial file
+            tmp_file = self.prometheus_file.with_name(self.prometheus_file.name + ".tmp")
+            with open(tmp_file, "w") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_file, self.prometheus_file)
+        self.last_export = time.monotonic()
+
+    def export_if_due(self):
+        if time.monotonic() - self.last_export >= self.export_interval:
+            self.export()